@@ -1072,7 +1072,7 @@ async function findOptimalStations(segments, criticalPoints, maxDetourKm, amenit
               $maxDistance: maxDetourKm * 1000 * 2
             }
           }
-        }).limit(15);
+        }).limit(15).select('-amenitiesDetail');
         console.log(`  Found ${nearbyStations.length} stations near critical point ${critical.index}`);
         if (nearbyStations.length > 0) {
           console.log(`  Sample: ${nearbyStations[0].name} at [${nearbyStations[0].longitude}, ${nearbyStations[0].latitude}]`);
@@ -1100,7 +1100,7 @@ async function findOptimalStations(segments, criticalPoints, maxDetourKm, amenit
               $maxDistance: maxDetourKm * 1000 * 3
             }
           }
-        }).limit(10);
+        }).limit(10).select('-amenitiesDetail');
         console.log(`  Found ${nearbyStations.length} stations`);
         stations = stations.concat(nearbyStations);
       } catch (error) {
@@ -1112,7 +1112,7 @@ async function findOptimalStations(segments, criticalPoints, maxDetourKm, amenit
   if (stations.length === 0) {
     console.log('⚠️ No stations found with geospatial queries, trying simple distance calculation...');
     try {
-      const allStations = await EVStation.find({ isOperational: true }).limit(100);
+      const allStations = await EVStation.find({ isOperational: true }).limit(100).select('-amenitiesDetail');
       console.log(`  Loaded ${allStations.length} stations for manual distance check`);
 
       const startPoint = segments[0];
@@ -1192,7 +1192,7 @@ async function calculateFinalMetrics(segments, totalDistanceKm, chargingStations
             $maxDistance: 25000 // 25km radius
           }
         }
-      }).limit(3);
+      }).limit(3).select('-amenitiesDetail');
 
       nearbyStations = stationsNearDest.map(station => {
         const distKm = haversineMeters(destSegment.lat, destSegment.lng,
@@ -1277,6 +1277,7 @@ async function formatEnhancedChargingStations(stops, candidateStations, charging
   return Promise.all(stops.map(async (stop, index) => {
     const station = candidateStations.find(s => s._id.toString() === stop.nodeId) || stop.station;
     if (!station) return null;
+    const amenityList = EVStation.amenityList(station);
 
     let closestSegment = segments[0];
     let minDist = Infinity;
@@ -1305,7 +1306,7 @@ async function formatEnhancedChargingStations(stops, candidateStations, charging
           station.type === 'fast' ? 'CCS-50kW' : 'Type2',
         powerKw: station.powerKw || 50, available: station.numberOfChargers || 1
       }],
-      amenities: station.amenitiesDetail || station.amenities.map(a => ({ name: a, type: a, available: true })),
+      amenities: amenityList.length > 0 ? amenityList : (station.amenities || []).map(a => ({ name: a, type: a, available: true })),
       isOptimal: index === 0, stopOrder: index + 1,
       notes: `Stop ${index + 1}: ${station.type || 'fast'} charging station with ${station.numberOfChargers || 1} chargers`,
       realTimeAvailability: station.numberOfChargers > 0 ? 'available' : 'unknown'
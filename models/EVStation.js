@@ -59,6 +59,12 @@ const EVStationSchema = new mongoose.Schema({
     lng: { type: Number }
   }],
 
+  // Compact per-category view written by the importer:
+  // { food: { count, nearest, top: [{ amenity, name, distance, lat, lng }] }, ... }
+  amenitiesSummary: {
+    type: mongoose.Schema.Types.Mixed
+  },
+
   powerKw: {
     type: Number,
     default: 50
@@ -88,6 +94,18 @@ EVStationSchema.pre('save', function(next) {
   next();
 });
 
+// Amenities for API responses: the inline amenitiesDetail when it has entries, otherwise the
+// nearest entries per category from amenitiesSummary (route-time reads exclude amenitiesDetail,
+// and the importer's separate/drop modes leave it empty). Works on documents and plain objects
+EVStationSchema.statics.amenityList = function(station) {
+  if (station.amenitiesDetail && station.amenitiesDetail.length > 0) {
+    return station.amenitiesDetail;
+  }
+  return Object.entries(station.amenitiesSummary || {})
+    .flatMap(([type, summary]) => ((summary && summary.top) || []).map(amenity => ({ type, ...amenity })))
+    .sort((a, b) => a.distance - b.distance);
+};
+
 // Geospatial 2dsphere index for location queries (critical for $near queries)
 EVStationSchema.index({ location: '2dsphere' });
 EVStationSchema.index({ isOperational: 1 });
@@ -1,15 +1,238 @@
+import argparse
+import contextlib
+import glob
+import hashlib
+import io
 import json
 import os
-import folium
+import struct
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import chain
+import numpy as np
 
 # Load route data from JSON file
 DATA_FILE = os.path.join(os.path.dirname(__file__), "route_data.json")
 
+# Douglas-Peucker tolerance (meters) applied to route lines before rendering; 0 keeps every point
+SIMPLIFY_TOLERANCE_M = 5.0
+# Levels of detail for --lod: (highest zoom the level is shown at, tolerance in meters)
+LOD_LEVELS = [(9, 250.0), (12, 40.0), (None, SIMPLIFY_TOLERANCE_M)]
+EARTH_RADIUS_M = 6371000.0
+
+# Batch mode: per-output-directory record of what each map was rendered from
+RENDER_CACHE_FILE = ".render_cache.json"
+RENDER_CACHE_VERSION = 2  # bump when rendering changes so cached maps are redrawn
+
+# Compact binary route files (--convert): magic, uint32 header length, JSON header, then
+# arrays on ROUTE_ALIGN-byte boundaries so they can be memory-mapped in place
+ROUTE_MAGIC = b"RWROUTE1"
+ROUTE_ALIGN = 16
+POLYLINE_PRECISION = 5
+
+# --format lite: a static Leaflet page that decodes encoded polylines client-side, so the
+# map needs neither folium nor a coordinate array per segment
+LEAFLET_CSS = "https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.css"
+LEAFLET_JS = "https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.js"
+# Agents/jobs: one color per planned tour (cycled), and the color of jobs no agent can take
+TOUR_COLORS = ["#e6194b", "#3cb44b", "#4363d8", "#f58231", "#911eb4", "#42d4f4", "#f032e6", "#9a6324"]
+UNASSIGNED_COLOR = "#999999"
+# plan_tours() holds dense job x job matrices (memory grows with the square of the job count),
+# so larger job sets fall back to straight agent lines
+SOLVE_MAX_JOBS = 2000
+
+# Large job sets are drawn as grid clusters: one grid of JOB_CLUSTER_CELL_PX screen pixels per
+# zoom band (used up to that zoom), individual jobs above the last band, and only what is in view
+JOB_CLUSTER_MIN_JOBS = 500
+JOB_CLUSTER_ZOOMS = [5, 7, 9, 11, 13, 15]
+JOB_CLUSTER_CELL_PX = 60
+OUTPUT_EXTENSIONS = {"folium": ".html", "lite": ".html", "geojson": ".geojson"}
+POLYLINE_DECODE_JS = """
+// Google encoded polyline -> [[lat, lon], ...]
+function decode(str, precision) {
+    var factor = Math.pow(10, precision), points = [], index = 0, lat = 0, lon = 0;
+    function next() {
+        var result = 0, shift = 0, b;
+        do {
+            b = str.charCodeAt(index++) - 63;
+            result |= (b & 0x1f) << shift;
+            shift += 5;
+        } while (b >= 0x20);
+        return result & 1 ? ~(result >> 1) : result >> 1;
+    }
+    while (index < str.length) {
+        lat += next();
+        lon += next();
+        points.push([lat / factor, lon / factor]);
+    }
+    return points;
+}
+"""
+JOB_CLUSTERS_JS = """
+// Draw cluster_jobs() data: the level for the current zoom, only inside the (padded) view
+function addJobClusters(map, clusters) {
+    var layer = L.layerGroup().addTo(map), jobs = clusters.jobs;
+    var levels = clusters.levels.map(function(level) {
+        return {maxZoom: level.maxZoom === null ? 99 : level.maxZoom, points: decode(level.path, clusters.precision), level: level};
+    });
+    function draw() {
+        var zoom = map.getZoom(), bounds = map.getBounds().pad(0.25);
+        var current = levels.filter(function(level) { return zoom <= level.maxZoom; })[0] || levels[levels.length - 1];
+        var level = current.level;
+        layer.clearLayers();
+        current.points.forEach(function(at, i) {
+            if (!bounds.contains(at)) {
+                return;
+            }
+            var n = level.count ? level.count[i] : 1, j = level.job ? level.job[i] : i;
+            if (n > 1) {
+                var size = 24 + 8 * Math.min(3, Math.floor(Math.log10(n)));
+                var html = '<div style="width:' + size + 'px;height:' + size + 'px;line-height:' + size + 'px;border-radius:50%;'
+                    + 'background:' + jobs.palette[level.color[i]] + ';opacity:0.85;color:#fff;font:bold 12px sans-serif;text-align:center">'
+                    + n + '</div>';
+                L.marker(at, {icon: L.divIcon({html: html, className: "", iconSize: [size, size]})})
+                    .bindPopup(n + " jobs, pickup: " + level.pickup[i] + ", duration: " + level.duration[i] + "s")
+                    .addTo(layer);
+            } else {
+                L.circleMarker(at, {radius: 4 + jobs.pickup[j] * 2, color: jobs.palette[jobs.color[j]], fill: true, fillOpacity: 0.7})
+                    .bindPopup("pickup: " + jobs.pickup[j] + ", duration: " + jobs.duration[j] + "s" + jobs.label[j])
+                    .addTo(layer);
+            }
+        });
+    }
+    map.on("moveend", draw);
+    draw();
+}
+"""
+# branca parses rendered scripts as templates again, and encoded polylines can contain "{{"
+JOB_CLUSTERS_TEMPLATE = """
+    {% macro script(this, kwargs) %}
+    {{ "{% raw %}" }}
+    {{ this.code }}
+    addJobClusters({{ this._parent.get_name() }}, {{ this.clusters }});
+    {{ "{% endraw %}" }}
+    {% endmacro %}
+"""
+LITE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<link rel="stylesheet" href="__LEAFLET_CSS__">
+<script src="__LEAFLET_JS__"></script>
+<style>html, body, #map { width: 100%; height: 100%; margin: 0; }</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+var data = __DATA__;
+__SCRIPTS__
+var map = L.map("map", {preferCanvas: true}).setView(data.center, data.zoom);
+L.tileLayer("https://tile.openstreetmap.org/{z}/{x}/{y}.png", {
+    maxZoom: 19,
+    attribution: "&copy; <a href=\\"https://www.openstreetmap.org/copyright\\">OpenStreetMap</a> contributors"
+}).addTo(map);
+function addLine(line, layer) {
+    var polyline = L.polyline(decode(line.path, data.precision), line.style).addTo(layer);
+    if (line.popup) {
+        polyline.bindPopup(line.popup);
+    }
+}
+// Show exactly one route level per zoom range: the first whose max zoom is >= the current zoom
+var levels = data.levels.map(function(level) {
+    var group = L.featureGroup();
+    level.lines.forEach(function(line) { addLine(line, group); });
+    return [level.maxZoom === null ? 99 : level.maxZoom, group];
+});
+function update() {
+    var zoom = map.getZoom(), shown = false;
+    levels.forEach(function(level) {
+        if (!shown && zoom <= level[0]) {
+            shown = true;
+            map.addLayer(level[1]);
+        } else {
+            map.removeLayer(level[1]);
+        }
+    });
+}
+map.on("zoomend", update);
+update();
+data.lines.forEach(function(line) { addLine(line, map); });
+if (data.jobClusters) {
+    addJobClusters(map, data.jobClusters);
+}
+if (data.jobs) {
+    decode(data.jobs.path, data.precision).forEach(function(at, i) {
+        var pickup = data.jobs.pickup[i];
+        L.circleMarker(at, {radius: 4 + pickup * 2, color: data.jobs.palette[data.jobs.color[i]], fill: true, fillOpacity: 0.7})
+            .bindPopup("pickup: " + pickup + ", duration: " + data.jobs.duration[i] + "s" + data.jobs.label[i])
+            .addTo(map);
+    });
+}
+data.markers.forEach(function(marker) {
+    L.circleMarker(marker.at, {radius: 8, color: marker.color, fillColor: marker.color, fillOpacity: 0.9})
+        .bindPopup(marker.popup)
+        .addTo(map);
+});
+</script>
+</body>
+</html>
+"""
+
+def _has_coordinates(geometry):
+    # GeoJSON geometry the map can draw; encoded polyline strings (OSRM's default) are not
+    return isinstance(geometry, dict) and isinstance(geometry.get("coordinates"), list)
+
+def _prune_route_object(obj):
+    # json object_hook: shrink OSRM/Mapbox objects to the fields the map uses as soon
+    # as the decoder builds them, so the maneuver/intersection payload never piles up
+    if "bearings" in obj or "entry" in obj:  # intersection
+        return {"location": obj.get("location")}
+    if "maneuver" in obj or "driving_side" in obj:  # step: intersections only matter without GeoJSON geometry
+        if _has_coordinates(obj.get("geometry")):
+            return {"geometry": obj["geometry"]}
+        return {"intersections": obj.get("intersections") or []}
+    if "steps" in obj and "summary" in obj:  # leg (drops annotations)
+        return {"steps": obj["steps"]}
+    if "hint" in obj:  # waypoint
+        return {"location": obj.get("location")}
+    return obj
+
+def _slim_route_data(data):
+    # Keep only what the map draws: routeCoordinates, agents/jobs, or the first route's
+    # GeoJSON geometry, step geometries (intersection locations for steps without one) and waypoints
+    slim = {k: data[k] for k in ("code", "routeCoordinates", "agents", "jobs") if k in data}
+    routes = data.get("routes")
+    if isinstance(routes, list) and routes:
+        first = routes[0]
+        route = {"legs": []}
+        if _has_coordinates(first.get("geometry")):
+            route["geometry"] = first["geometry"]
+        for leg in first.get("legs", []):
+            steps = []
+            for step in leg.get("steps", []):
+                slim_step = {}
+                if _has_coordinates(step.get("geometry")):
+                    slim_step["geometry"] = step["geometry"]
+                elif "intersections" in step:
+                    slim_step["intersections"] = [{"location": i.get("location")} for i in step["intersections"]]
+                steps.append(slim_step)
+            route["legs"].append({"steps": steps})
+        slim["routes"] = [route]
+    if "waypoints" in data:
+        slim["waypoints"] = [{"location": w.get("location")} for w in data["waypoints"]]
+    return slim
+
 def load_route_data(path):
     if not os.path.exists(path):
         raise FileNotFoundError(f"Route data file not found: {path}")
+    with open(path, "rb") as f:
+        is_binary = f.read(len(ROUTE_MAGIC)) == ROUTE_MAGIC
+    if is_binary:
+        return load_route_binary(path)
     with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+        data = _slim_route_data(json.load(f, object_hook=_prune_route_object))
 
     # Accept routeCoordinates format
     if "routeCoordinates" in data:
@@ -29,62 +252,89 @@ def load_route_data(path):
 
     raise ValueError("Invalid route data: expected 'routeCoordinates' or 'agents'/'jobs' or 'routes'")
 
+def _lonlat_array(points):
+    # [[lon, lat], ...] -> contiguous float64 array of (lat, lon) rows; malformed entries become NaN rows
+    try:
+        # Fast path: every entry is a plain [lon, lat] pair
+        if set(map(len, points)) == {2}:
+            flat = np.fromiter(chain.from_iterable(points), dtype=np.float64, count=2 * len(points))
+            return np.ascontiguousarray(flat.reshape(-1, 2)[:, ::-1])
+    except (TypeError, ValueError):
+        pass
+    rows = []
+    for c in points:
+        try:
+            rows.append((float(c[1]), float(c[0])))
+        except Exception:
+            rows.append((np.nan, np.nan))
+    return np.array(rows, dtype=np.float64).reshape(-1, 2)
+
+def _valid_rows(coords):
+    return coords[~np.isnan(coords).any(axis=1)]
+
+def _steps_array(route):
+    # One route's step geometries (or intersection locations) concatenated into (lat, lon)
+    # rows without malformed or repeated consecutive points - adjacent steps share their
+    # boundary vertex - plus the row each step and each leg starts at
+    points, step_starts, leg_starts = [], [], []
+    for leg in route.get("legs", []):
+        leg_starts.append(len(step_starts))
+        for step in leg.get("steps", []):
+            step_starts.append(len(points))
+            if _has_coordinates(step.get("geometry")):
+                points.extend(step["geometry"]["coordinates"])
+            else:
+                points.extend(i.get("location") or [] for i in step.get("intersections", []))
+    empty = np.empty(0, dtype=np.int64)
+    if not points:
+        return np.empty((0, 2)), empty, empty
+
+    raw = _lonlat_array(points)
+    keep = ~np.isnan(raw).any(axis=1)
+    valid = np.flatnonzero(keep)
+    if len(valid) > 1:
+        repeated = np.all(raw[valid[1:]] == raw[valid[:-1]], axis=1)
+        keep[valid[1:][repeated]] = False
+    coords = raw[keep]
+
+    # Raw index -> row of the kept point at or before it
+    row_of = np.maximum(np.cumsum(keep) - 1, 0)
+    step_starts = row_of[np.minimum(step_starts, len(raw) - 1)] if step_starts else empty
+    leg_starts = step_starts[leg_starts] if leg_starts and len(step_starts) else empty
+    return coords, np.asarray(step_starts, dtype=np.int64), np.asarray(leg_starts, dtype=np.int64)
+
 def _extract_coords_from_routes(data):
-    # Try geometry.coordinates (lon,lat)
+    # Route geometry as one contiguous float64 array of (lat, lon) rows, or None
     routes = data.get("routes") or []
     if not routes:
         return None
     first = routes[0]
-    geom = first.get("geometry") or {}
-    coords = []
-    if isinstance(geom, dict) and isinstance(geom.get("coordinates"), list):
-        for c in geom["coordinates"]:
-            if c and len(c) >= 2:
-                try:
-                    lon = float(c[0]); lat = float(c[1])
-                    coords.append((lat, lon))
-                except Exception:
-                    continue
-        if coords:
+
+    # Try geometry.coordinates (lon,lat)
+    if _has_coordinates(first.get("geometry")):
+        coords = _valid_rows(_lonlat_array(first["geometry"]["coordinates"]))
+        if len(coords):
             return coords
 
-    # Fallback: collect coordinates from steps' geometry or intersections
-    for leg in first.get("legs", []):
-        for step in leg.get("steps", []):
-            sgeom = step.get("geometry") or {}
-            if isinstance(sgeom, dict) and isinstance(sgeom.get("coordinates"), list):
-                for c in sgeom["coordinates"]:
-                    if c and len(c) >= 2:
-                        try:
-                            lon = float(c[0]); lat = float(c[1])
-                            coords.append((lat, lon))
-                        except Exception:
-                            continue
-            else:
-                for inter in step.get("intersections", []):
-                    loc = inter.get("location")
-                    if loc and len(loc) >= 2:
-                        try:
-                            lon = float(loc[0]); lat = float(loc[1])
-                            coords.append((lat, lon))
-                        except Exception:
-                            continue
-    if coords:
+    # Fallback: concatenate steps' geometry or intersections
+    coords = _steps_array(first)[0]
+    if len(coords):
         return coords
 
     # Final fallback: waypoints
-    for wp in data.get("waypoints", []):
-        loc = wp.get("location")
-        if loc and len(loc) >= 2:
-            try:
-                lon = float(loc[0]); lat = float(loc[1])
-                coords.append((lat, lon))
-            except Exception:
-                continue
-    return coords or None
-
-def build_map(route_data, out_html="route_map.html"):
-    # If old-style routeCoordinates present, keep original behavior
+    coords = _valid_rows(_lonlat_array([wp.get("location") or [] for wp in data.get("waypoints", [])]))
+    return coords if len(coords) else None
+
+def route_line(route_data):
+    # (coords, colors) of a line format: an (N, 2) float64 array of (lat, lon) rows and the
+    # per-point trafficColor array (segment i -> i + 1 uses colors[i]) or None; None for agents/jobs
+    if "routeArrays" in route_data:
+        arrays = route_data["routeArrays"]
+        if "colors" not in arrays:
+            return arrays["coords"], None
+        return arrays["coords"], np.asarray(route_data["palette"])[arrays["colors"]]
+
+    # Old-style routeCoordinates: [{"lat", "lng", "trafficColor"}, ...]
     if "routeCoordinates" in route_data:
         coords = []
         for p in route_data["routeCoordinates"]:
@@ -95,103 +345,523 @@ def build_map(route_data, out_html="route_map.html"):
             except Exception as e:
                 raise ValueError(f"Invalid coordinate entry: {p}") from e
             coords.append((lat, lng))
-
         if not coords:
             raise ValueError("No coordinates to plot")
+        colors = [p.get("trafficColor", "#3388ff") for p in route_data["routeCoordinates"]]
+        return np.array(coords, dtype=np.float64), np.asarray(colors)
+
+    # OSRM/Mapbox-style routes (routes[0].geometry.coordinates)
+    if "routes" in route_data:
+        coords = _extract_coords_from_routes(route_data)
+        if coords is None:
+            raise ValueError("No coordinates found in 'routes' to plot")
+        return coords, None
+    return None
+
+def encode_polyline(coords, precision=POLYLINE_PRECISION):
+    # Google encoded polyline of (lat, lon) rows
+    scaled = np.round(np.asarray(coords, dtype=np.float64) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(scaled, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    out = []
+    for value in deltas.tolist():
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            out.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        out.append(chr(value + 63))
+    return "".join(out)
+
+def convert_route_file(src, dst, polyline=False):
+    # Write src's route line to dst as a binary route file: coords, traffic colors as
+    # indices into a palette, step/leg start rows when the line is the step geometry, and
+    # optionally the encoded polyline. Returns the number of points
+    route_data = load_route_data(src)
+    line = route_line(route_data)
+    if line is None:
+        raise ValueError("Only routeCoordinates and routes data have a route line to convert")
+    coords, colors = line
+    header = {"version": 1, "source": os.path.basename(src), "count": len(coords)}
+    arrays = {"coords": np.ascontiguousarray(coords, dtype=np.float64)}
+    if colors is not None:
+        palette, codes = np.unique(colors, return_inverse=True)
+        header["palette"] = palette.tolist()
+        arrays["colors"] = codes.astype(np.uint8 if len(palette) <= 256 else np.uint16)
+    if "routes" in route_data:
+        step_coords, step_starts, leg_starts = _steps_array(route_data["routes"][0])
+        # Offsets only describe the line when it was built from (or matches) the steps
+        if len(step_starts) and np.array_equal(step_coords, coords):
+            arrays["stepOffsets"] = step_starts
+            arrays["legOffsets"] = leg_starts
+    if polyline:
+        header["polylinePrecision"] = POLYLINE_PRECISION
+        arrays["polyline"] = np.frombuffer(encode_polyline(coords).encode("ascii"), dtype=np.uint8)
+
+    # Lay arrays out after the header on ROUTE_ALIGN-byte boundaries
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += -(-array.nbytes // ROUTE_ALIGN) * ROUTE_ALIGN
+    header["arrays"] = layout
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = -(-(len(ROUTE_MAGIC) + 4 + len(header_bytes)) // ROUTE_ALIGN) * ROUTE_ALIGN
+
+    tmp_path = dst + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(ROUTE_MAGIC)
+        f.write(struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, dst)
+    return len(coords)
+
+def load_route_binary(path):
+    # Memory-map a file written by convert_route_file: {"routeArrays": {name: array}, "palette", ...}
+    with open(path, "rb") as f:
+        if f.read(len(ROUTE_MAGIC)) != ROUTE_MAGIC:
+            raise ValueError(f"Not a binary route file: {path}")
+        header_len = struct.unpack("<I", f.read(4))[0]
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    data_start = -(-(len(ROUTE_MAGIC) + 4 + header_len) // ROUTE_ALIGN) * ROUTE_ALIGN
+
+    arrays = {}
+    for name, spec in header.pop("arrays").items():
+        shape = tuple(spec["shape"])
+        if shape[0] == 0:
+            arrays[name] = np.empty(shape, dtype=np.dtype(spec["dtype"]))
+        else:
+            arrays[name] = np.memmap(path, dtype=np.dtype(spec["dtype"]), mode="r",
+                                     offset=data_start + spec["offset"], shape=shape)
+    if not header["count"]:
+        raise ValueError("No coordinates to plot")
+    if "polyline" in arrays:
+        header["polyline"] = arrays.pop("polyline").tobytes().decode("ascii")
+    return dict(header, routeArrays=arrays)
+
+def simplify_indices(coords, tolerance_m, keep=()):
+    # Douglas-Peucker over (lat, lon) points in a local equirectangular projection (meters).
+    # Returns the indices that survive; the first/last point and every index in keep
+    # (e.g. traffic color boundaries) always do
+    n = len(coords)
+    if n < 3 or not tolerance_m or tolerance_m <= 0:
+        return np.arange(n)
+    pts = np.radians(np.asarray(coords, dtype=np.float64))
+    x = pts[:, 1] * np.cos(pts[:, 0].mean()) * EARTH_RADIUS_M
+    y = pts[:, 0] * EARTH_RADIUS_M
+
+    mask = np.zeros(n, dtype=bool)
+    mask[[0, n - 1]] = True
+    mask[list(keep)] = True
+    anchors = np.flatnonzero(mask)
+    stack = [(a, b) for a, b in zip(anchors[:-1], anchors[1:]) if b - a > 1]
+    while stack:
+        a, b = stack.pop()
+        dx, dy = x[b] - x[a], y[b] - y[a]
+        px, py = x[a + 1:b] - x[a], y[a + 1:b] - y[a]
+        length2 = dx * dx + dy * dy
+        if length2 > 0:
+            t = np.clip((px * dx + py * dy) / length2, 0, 1)
+            dist = np.hypot(px - t * dx, py - t * dy)
+        else:
+            dist = np.hypot(px, py)
+        i = int(dist.argmax())
+        if dist[i] > tolerance_m:
+            k = a + 1 + i
+            mask[k] = True
+            if k - a > 1:
+                stack.append((a, k))
+            if b - k > 1:
+                stack.append((k, b))
+    return np.flatnonzero(mask)
+
+# Shows exactly one layer per zoom range: the first whose max zoom is >= the current zoom
+ZOOM_LEVELS_TEMPLATE = """
+    {% macro script(this, kwargs) %}
+    (function() {
+        var map = {{ this._parent.get_name() }};
+        var levels = [{% for max_zoom, layer in this.levels %}[{{ max_zoom if max_zoom is not none else 99 }}, {{ layer.get_name() }}]{{ "," if not loop.last }}{% endfor %}];
+        function update() {
+            var zoom = map.getZoom(), shown = false;
+            levels.forEach(function(level) {
+                if (!shown && zoom <= level[0]) {
+                    shown = true;
+                    map.addLayer(level[1]);
+                } else {
+                    map.removeLayer(level[1]);
+                }
+            });
+        }
+        map.on("zoomend", update);
+        update();
+    })();
+    {% endmacro %}
+"""
 
-        m = folium.Map(location=coords[0], zoom_start=10)
+def _add_macro(m, name, template, **attrs):
+    # Attach a script element rendered from a jinja macro template (with attrs on `this`) to a folium map
+    from branca.element import MacroElement
+    from jinja2 import Template
+    element = MacroElement()
+    element._name = name
+    element._template = Template(template)
+    for key, value in attrs.items():
+        setattr(element, key, value)
+    element.add_to(m)
 
-        # Draw colored segments for traffic
-        for i in range(len(coords) - 1):
-            color = route_data["routeCoordinates"][i].get("trafficColor", "#3388ff")
+def color_runs(indices, colors):
+    # Group consecutive segments sharing a color: [(color, point indices), ...] where the
+    # segment starting at point i has colors[i]; neighbouring runs share their boundary point
+    runs = []
+    start = 0
+    for j in range(1, len(indices)):
+        if j == len(indices) - 1 or colors[indices[j]] != colors[indices[start]]:
+            runs.append((colors[indices[start]], indices[start:j + 1]))
+            start = j
+    return runs
+
+def route_levels(coords, colors=None, tolerance_m=SIMPLIFY_TOLERANCE_M, lod=False):
+    # The route simplified to tolerance_m, or once per LOD_LEVELS entry:
+    # [(max zoom or None, tolerance, [(color, (K, 2) points), ...]), ...]. colors[i] is the
+    # color of segment i -> i + 1; color changes are kept as breakpoints so every run keeps
+    # its exact extent. Without colors there is one "#3388ff" run
+    pts = np.asarray(coords, dtype=np.float64)
+    if colors is not None:
+        colors = np.asarray(colors)
+        breaks = np.flatnonzero(colors[1:-1] != colors[:-2]) + 1
+    else:
+        breaks = []
+    levels = []
+    for max_zoom, tol in (LOD_LEVELS if lod else [(None, tolerance_m)]):
+        kept = simplify_indices(pts, tol, breaks)
+        print(f"🪄 Simplified route {len(pts)} -> {len(kept)} points "
+              f"({100 * (1 - len(kept) / max(1, len(pts))):.0f}% fewer) at {tol:g}m"
+              + (f" for zoom <= {max_zoom}" if lod and max_zoom is not None else " for higher zooms" if lod else ""))
+        if colors is not None:
+            # One polyline per traffic color run instead of one per segment
+            runs = [(str(color), pts[run]) for color, run in color_runs(kept, colors)]
+        else:
+            runs = [("#3388ff", pts[kept])]
+        levels.append((max_zoom, tol, runs))
+    return levels
+
+def _add_route_lines(m, coords, colors=None, tolerance_m=SIMPLIFY_TOLERANCE_M, lod=False):
+    # Draw route_levels() on a folium map; with lod each level is a layer switched by zoom
+    import folium
+    groups = []
+    for max_zoom, tol, runs in route_levels(coords, colors, tolerance_m, lod):
+        target = folium.FeatureGroup(name=f"route {tol:g}m", control=False).add_to(m) if lod else m
+        for color, run in runs:
             folium.PolyLine(
-                [coords[i], coords[i + 1]],
+                run.tolist(),
                 color=color,
                 weight=6,
                 opacity=0.8
-            ).add_to(m)
+            ).add_to(target)
+        groups.append((max_zoom, target))
+    if lod:
+        _add_macro(m, "ZoomLevels", ZOOM_LEVELS_TEMPLATE, levels=groups)
 
-        # Add start & end markers
-        folium.Marker(coords[0], popup="Start", icon=folium.Icon(color="green")).add_to(m)
-        folium.Marker(coords[-1], popup="End", icon=folium.Icon(color="red")).add_to(m)
+def agents_and_jobs(route_data):
+    # Parse the agents/jobs payload: (all points, job markers, agent markers) with (lat, lon)
+    # tuples; entries without a usable location are skipped
+    agents = route_data["agents"]
+    jobs = route_data["jobs"]
 
-        m.save(out_html)
-        return out_html
+    # Collect coordinates (note: input is [lon, lat] -> maps expect [lat, lon])
+    points = []
+    job_markers = []
+    for j in jobs:
+        loc = j.get("location")
+        if not loc or len(loc) < 2:
+            continue
+        lat, lon = float(loc[1]), float(loc[0])
+        points.append((lat, lon))
+        job_markers.append({
+            "loc": (lat, lon),
+            "pickup": int(j.get("pickup_amount", 1)),
+            "duration": int(j.get("duration", 0))
+        })
 
-    # New: visualize OSRM/Mapbox-style routes (routes[0].geometry.coordinates)
-    if "routes" in route_data:
-        coords = _extract_coords_from_routes(route_data)
-        if not coords:
-            raise ValueError("No coordinates found in 'routes' to plot")
+    agent_markers = []
+    for a in agents:
+        s = a.get("start_location")
+        e = a.get("end_location")
+        cap = a.get("pickup_capacity", None)
+        start = None
+        end = None
+        if s and len(s) >= 2:
+            start = (float(s[1]), float(s[0]))
+            points.append(start)
+        if e and len(e) >= 2:
+            end = (float(e[1]), float(e[0]))
+            points.append(end)
+        agent_markers.append({"start": start, "end": end, "capacity": cap})
+
+    if not points:
+        raise ValueError("No coordinates found in agents/jobs to plot")
+    return points, job_markers, agent_markers
+
+def haversine_matrix(points):
+    # Great-circle distances (meters) between every pair of (lat, lon) points
+    p = np.radians(np.asarray(points, dtype=np.float64).reshape(-1, 2))
+    lat, lon = p[:, 0], p[:, 1]
+    a = (np.sin((lat[:, None] - lat[None, :]) / 2) ** 2
+         + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin((lon[:, None] - lon[None, :]) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def _two_opt(seq, dist):
+    # Reverse inner segments of seq while that shortens it; the first and last node stay put
+    seq = np.asarray(seq)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(seq) - 2):
+            # Replacing edges (seq[i-1], seq[i]) and (seq[j], seq[j+1]) for every j > i at once
+            a, b = seq[i - 1], seq[i]
+            c, d = seq[i + 1:-1], seq[i + 2:]
+            delta = dist[a, c] + dist[b, d] - dist[a, b] - dist[c, d]
+            k = int(delta.argmin())
+            if delta[k] < -1e-6:
+                seq[i:i + k + 2] = seq[i:i + k + 2][::-1].copy()
+                improved = True
+    return seq
 
-        m = folium.Map(location=coords[0], zoom_start=10)
+def plan_tours(job_markers, agent_markers):
+    # Assign jobs to agents and order them: capacitated cheapest insertion, then 2-opt per
+    # tour, over straight-line distances. Each agent runs start -> jobs -> end (a missing start
+    # or end leaves that side open) and the pickups of its jobs stay within pickup_capacity.
+    # Returns ([{"agent", "jobs": job indices in visiting order, "load", "distance_m"}, ...],
+    # unassigned job indices)
+    n_jobs = len(job_markers)
+    agents = [i for i, am in enumerate(agent_markers) if am["start"] or am["end"]]
+    if not agents:
+        return [], list(range(n_jobs))
 
-        # Draw the full route
-        folium.PolyLine(coords, color="#3388ff", weight=6, opacity=0.8).add_to(m)
+    # Nodes: jobs, then each routed agent's start and end, then one "open end" node that is
+    # zero distance from everything
+    free = n_jobs + 2 * len(agents)
+    points = [jm["loc"] for jm in job_markers]
+    for i in agents:
+        points += [agent_markers[i]["start"] or (0.0, 0.0), agent_markers[i]["end"] or (0.0, 0.0)]
+    dist = np.zeros((free + 1, free + 1))
+    dist[:free, :free] = haversine_matrix(points + [(0.0, 0.0)])[:free, :free]
+    starts = [n_jobs + 2 * k if agent_markers[i]["start"] else free for k, i in enumerate(agents)]
+    ends = [n_jobs + 2 * k + 1 if agent_markers[i]["end"] else free for k, i in enumerate(agents)]
+
+    demand = np.array([jm["pickup"] for jm in job_markers], dtype=np.float64)
+    remaining = np.array([np.inf if agent_markers[i]["capacity"] is None else float(agent_markers[i]["capacity"])
+                          for i in agents])
+
+    # Every tour edge is an insertion slot; cost[j, e] is the detour of putting job j into edge e
+    edge_from = np.zeros(n_jobs + len(agents), dtype=np.int64)
+    edge_to = np.zeros_like(edge_from)
+    edge_tour = np.zeros_like(edge_from)
+    edge_from[:len(agents)], edge_to[:len(agents)], edge_tour[:len(agents)] = starts, ends, np.arange(len(agents))
+    n_edges = len(agents)
+    cost = np.full((n_jobs, len(edge_from)), np.inf)
+    cost[:, :n_edges] = dist[:n_jobs, starts] + dist[:n_jobs, ends] - dist[starts, ends]
+    def cheapest(rows, n_edges):
+        # Cheapest slot each job in rows fits into, as (detour, edge); inf where none fits
+        fits = demand[rows, None] <= remaining[edge_tour[:n_edges]][None, :]
+        masked = np.where(fits, cost[rows, :n_edges], np.inf)
+        edge = masked.argmin(axis=1)
+        return masked[np.arange(len(rows)), edge], edge
+
+    tours = [[] for _ in agents]
+    successor = {}
+    placed = np.zeros(n_jobs, dtype=bool)
+    best, best_edge = cheapest(np.arange(n_jobs), n_edges)
+    for _ in range(n_jobs):
+        j = int(best.argmin())
+        if not np.isfinite(best[j]):
+            break
+        e = best_edge[j]
+        a, b, t = edge_from[e], edge_to[e], edge_tour[e]
+        placed[j] = True
+        best[j] = np.inf
+        remaining[t] -= demand[j]
+        tours[t].append(j)
+        successor[(t, a)] = j
+        successor[(t, j)] = b
+
+        # Jobs whose cheapest slot was the edge being split, or that no longer fit this tour,
+        # are rescanned below; everyone else only has to look at the two new slots
+        waiting = ~placed
+        stale = waiting & ((best_edge == e) | ((edge_tour[best_edge] == t) & (demand > remaining[t])))
+
+        # Edge e becomes a -> j and a new edge j -> b is appended
+        edge_to[e] = j
+        edge_from[n_edges], edge_to[n_edges], edge_tour[n_edges] = j, b, t
+        cost[:, e] = dist[:n_jobs, a] + dist[:n_jobs, j] - dist[a, j]
+        cost[:, n_edges] = dist[:n_jobs, j] + dist[:n_jobs, b] - dist[j, b]
+        n_edges += 1
+
+        fits = waiting & ~stale & (demand <= remaining[t])
+        for edge in (e, n_edges - 1):
+            better = fits & (cost[:, edge] < best)
+            best[better] = cost[better, edge]
+            best_edge[better] = edge
+        rows = np.flatnonzero(stale)
+        if len(rows):
+            best[rows], best_edge[rows] = cheapest(rows, n_edges)
+
+    plans = []
+    for t, i in enumerate(agents):
+        seq, node = [starts[t]], starts[t]
+        for _ in tours[t]:
+            node = successor[(t, node)]
+            seq.append(node)
+        seq = _two_opt(seq + [ends[t]], dist)
+        plans.append({
+            "agent": i,
+            "jobs": [int(n) for n in seq[1:-1]],
+            "load": float(demand[tours[t]].sum()),
+            "distance_m": float(dist[seq[:-1], seq[1:]].sum())
+        })
+    return plans, [int(j) for j in np.flatnonzero(~placed)]
+
+def agent_routes(job_markers, agent_markers, solve=True, solve_max_jobs=SOLVE_MAX_JOBS):
+    # Lines to draw per agent, [(style, (K, 2) points, popup)], and the job markers with a
+    # "color" and "label" (popup suffix). With solve each agent's line is its planned tour
+    # (up to solve_max_jobs jobs); otherwise it is the dashed straight start -> end line
+    if solve and len(job_markers) > solve_max_jobs:
+        print(f"⚠️  {len(job_markers)} jobs is over the tour planning limit of {solve_max_jobs} "
+              f"(--solve-max-jobs); drawing straight agent lines instead")
+        solve = False
+    if not solve:
+        lines = [({"color": "#444444", "weight": 2, "opacity": 0.8, "dashArray": "5"}, np.array([am["start"], am["end"]]), None)
+                 for am in agent_markers if am["start"] and am["end"]]
+        return lines, [dict(jm, color="#1f77b4", label="") for jm in job_markers]
+
+    started = time.perf_counter()
+    plans, unassigned = plan_tours(job_markers, agent_markers)
+    jobs = [dict(jm, color=UNASSIGNED_COLOR, label=", unassigned", agent=None) for jm in job_markers]
+    lines = []
+    for k, plan in enumerate(plans):
+        am = agent_markers[plan["agent"]]
+        color = TOUR_COLORS[k % len(TOUR_COLORS)]
+        for j in plan["jobs"]:
+            jobs[j].update(color=color, label=f", agent {plan['agent']}", agent=plan["agent"])
+        stops = ([am["start"]] if am["start"] else []) + [job_markers[j]["loc"] for j in plan["jobs"]] + ([am["end"]] if am["end"] else [])
+        if len(stops) > 1:
+            capacity = "" if am["capacity"] is None else f"/{am['capacity']}"
+            popup = (f"Agent {plan['agent']}: {len(plan['jobs'])} jobs, load {plan['load']:g}{capacity}, "
+                     f"{plan['distance_m'] / 1000:.1f} km")
+            lines.append(({"color": color, "weight": 3, "opacity": 0.8}, np.array(stops), popup))
+    print(f"🚚 Planned {len(plans)} tours covering {len(job_markers) - len(unassigned)}/{len(job_markers)} jobs "
+          f"({sum(p['distance_m'] for p in plans) / 1000:.1f} km straight-line, {len(unassigned)} unassigned) "
+          f"in {1000 * (time.perf_counter() - started):.0f} ms")
+    return lines, jobs
+
+def _job_data(jobs):
+    # Per-job attributes of agent_routes() job markers for the page scripts; colors as palette indices
+    palette = sorted({jm["color"] for jm in jobs})
+    index = {color: i for i, color in enumerate(palette)}
+    return {
+        "pickup": [jm["pickup"] for jm in jobs],
+        "duration": [jm["duration"] for jm in jobs],
+        "palette": palette,
+        "color": [index[jm["color"]] for jm in jobs],
+        "label": [jm["label"] for jm in jobs]
+    }
+
+def cluster_jobs(jobs, zooms=JOB_CLUSTER_ZOOMS, cell_px=JOB_CLUSTER_CELL_PX):
+    # Grid-aggregate agent_routes() job markers once per zoom band, in cells of cell_px Web
+    # Mercator pixels at the band's max zoom. Each cluster has its centroid, job count, summed
+    # pickup and duration, most common color and one member job; the last level holds the
+    # individual jobs. Returns the data the JOB_CLUSTERS_JS addJobClusters() draws
+    started = time.perf_counter()
+    job_data = _job_data(jobs)
+    pts = np.array([jm["loc"] for jm in jobs], dtype=np.float64)
+    pickup = np.array(job_data["pickup"], dtype=np.float64)
+    duration = np.array(job_data["duration"], dtype=np.float64)
+    color = np.array(job_data["color"], dtype=np.int64)
+    n_colors = len(job_data["palette"])
+
+    # World pixel coordinates at zoom 0 (256 px wide)
+    lat = np.radians(np.clip(pts[:, 0], -85.05, 85.05))
+    world = np.stack([(pts[:, 1] + 180) / 360 * 256, (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * 256], axis=1)
+    levels = []
+    for zoom in zooms:
+        cells = np.floor(world * 2 ** zoom / cell_px).astype(np.int64)
+        _, inverse = np.unique(cells, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        k = int(inverse.max()) + 1
+        count = np.bincount(inverse, minlength=k)
+        centroids = np.stack([np.bincount(inverse, pts[:, 0], k), np.bincount(inverse, pts[:, 1], k)], axis=1) / count[:, None]
+        dominant = np.bincount(inverse * n_colors + color, minlength=k * n_colors).reshape(k, n_colors).argmax(axis=1)
+        member = np.full(k, len(pts))
+        np.minimum.at(member, inverse, np.arange(len(pts)))
+        levels.append({
+            "maxZoom": zoom,
+            "path": encode_polyline(centroids),
+            "count": count.tolist(),
+            "pickup": np.bincount(inverse, pickup, k).astype(np.int64).tolist(),
+            "duration": np.bincount(inverse, duration, k).astype(np.int64).tolist(),
+            "color": dominant.tolist(),
+            "job": member.tolist()
+        })
+    levels.append({"maxZoom": None, "path": encode_polyline(pts)})
+    print(f"🗂️  Clustered {len(jobs)} jobs into " + ", ".join(f"{len(level['count'])}" for level in levels[:-1])
+          + f" markers for zooms <= {', '.join(map(str, zooms))} in {1000 * (time.perf_counter() - started):.0f} ms")
+    return {"precision": POLYLINE_PRECISION, "jobs": job_data, "levels": levels}
+
+def build_map(route_data, out_html="route_map.html", tolerance_m=SIMPLIFY_TOLERANCE_M, lod=False, output="folium",
+              solve=True, cluster_min_jobs=JOB_CLUSTER_MIN_JOBS, solve_max_jobs=SOLVE_MAX_JOBS):
+    # output="lite" writes a static page with encoded polylines, "geojson" a FeatureCollection;
+    # neither imports folium. solve plans agents/jobs tours (up to solve_max_jobs jobs) instead
+    # of straight agent lines; from cluster_min_jobs jobs on, jobs are drawn as zoom-dependent clusters
+    if output != "folium":
+        return build_light_map(route_data, out_html, tolerance_m, lod, output, solve, cluster_min_jobs, solve_max_jobs)
+    import folium
+
+    # Route lines: routeCoordinates (colored by traffic), routes, or a binary route file
+    line = route_line(route_data)
+    if line is not None:
+        coords, colors = line
+        start, end = coords[0].tolist(), coords[-1].tolist()
+
+        m = folium.Map(location=start, zoom_start=10)
+
+        # Draw the route
+        _add_route_lines(m, coords, colors, tolerance_m, lod)
 
         # Add start & end markers
-        folium.Marker(coords[0], popup="Start", icon=folium.Icon(color="green")).add_to(m)
-        folium.Marker(coords[-1], popup="End", icon=folium.Icon(color="red")).add_to(m)
+        folium.Marker(start, popup="Start", icon=folium.Icon(color="green")).add_to(m)
+        folium.Marker(end, popup="End", icon=folium.Icon(color="red")).add_to(m)
 
         m.save(out_html)
         return out_html
 
-    # New: visualize agents/jobs dummy data (unchanged)
+    # New: visualize agents/jobs data, with planned tours unless solve is off
     if "agents" in route_data and "jobs" in route_data:
-        agents = route_data["agents"]
-        jobs = route_data["jobs"]
-
-        # Collect coordinates (note: input is [lon, lat] -> folium expects [lat, lon])
-        points = []
-        job_markers = []
-        for j in jobs:
-            loc = j.get("location")
-            if not loc or len(loc) < 2:
-                continue
-            lat, lon = float(loc[1]), float(loc[0])
-            points.append((lat, lon))
-            job_markers.append({
-                "loc": (lat, lon),
-                "pickup": int(j.get("pickup_amount", 1)),
-                "duration": int(j.get("duration", 0))
-            })
-
-        agent_markers = []
-        for a in agents:
-            s = a.get("start_location")
-            e = a.get("end_location")
-            cap = a.get("pickup_capacity", None)
-            start = None
-            end = None
-            if s and len(s) >= 2:
-                start = (float(s[1]), float(s[0]))
-                points.append(start)
-            if e and len(e) >= 2:
-                end = (float(e[1]), float(e[0]))
-                points.append(end)
-            agent_markers.append({"start": start, "end": end, "capacity": cap})
-
-        if not points:
-            raise ValueError("No coordinates found in agents/jobs to plot")
+        points, job_markers, agent_markers = agents_and_jobs(route_data)
+        lines, job_markers = agent_routes(job_markers, agent_markers, solve, solve_max_jobs)
 
         # center map on mean of collected points
         avg_lat = sum(p[0] for p in points) / len(points)
         avg_lon = sum(p[1] for p in points) / len(points)
         m = folium.Map(location=(avg_lat, avg_lon), zoom_start=14)
 
-        # Add job markers (circle size ~ pickup_amount)
+        # Add job markers (circle size ~ pickup_amount), clustered when there are many
+        if len(job_markers) >= cluster_min_jobs:
+            clusters = json.dumps(cluster_jobs(job_markers), separators=(",", ":")).replace("</", "<\\/")
+            _add_macro(m, "JobClusters", JOB_CLUSTERS_TEMPLATE, code=POLYLINE_DECODE_JS + JOB_CLUSTERS_JS, clusters=clusters)
+            job_markers = []
         for jm in job_markers:
             radius = 4 + jm["pickup"] * 2
             folium.CircleMarker(
                 location=jm["loc"],
                 radius=radius,
-                color="#1f77b4",
+                color=jm["color"],
                 fill=True,
                 fill_opacity=0.7,
-                popup=f"pickup: {jm['pickup']}, duration: {jm['duration']}s"
+                popup=f"pickup: {jm['pickup']}, duration: {jm['duration']}s{jm['label']}"
             ).add_to(m)
 
-        # Add agent start/end markers and simple straight lines (start->end)
+        # Add agent start/end markers
         for idx, am in enumerate(agent_markers):
             if am["start"]:
                 folium.Marker(
@@ -205,36 +875,309 @@ def build_map(route_data, out_html="route_map.html"):
                     popup=f"Agent {idx} end",
                     icon=folium.Icon(color="red", icon="stop")
                 ).add_to(m)
-            if am["start"] and am["end"]:
-                folium.PolyLine(
-                    [am["start"], am["end"]],
-                    color="#444444",
-                    weight=2,
-                    opacity=0.8,
-                    dash_array="5"
-                ).add_to(m)
+
+        # Tours (or straight start->end lines)
+        for style, line_points, popup in lines:
+            folium.PolyLine(
+                line_points.tolist(),
+                color=style["color"],
+                weight=style["weight"],
+                opacity=style["opacity"],
+                dash_array=style.get("dashArray"),
+                popup=popup
+            ).add_to(m)
 
         m.save(out_html)
         return out_html
 
     raise ValueError("Unsupported route data format")
 
+def map_layers(route_data, tolerance_m=SIMPLIFY_TOLERANCE_M, lod=False, solve=True, solve_max_jobs=SOLVE_MAX_JOBS):
+    # What build_map draws, as plain data for the lite and geojson outputs:
+    # {"center", "zoom", "levels": route_levels(), "lines": [(style, points, popup)],
+    #  "markers": [(point, color, popup)], "jobs": agent_routes() job markers}
+    line = route_line(route_data)
+    if line is not None:
+        coords, colors = line
+        start, end = coords[0].tolist(), coords[-1].tolist()
+        return {
+            "center": start,
+            "zoom": 10,
+            "levels": route_levels(coords, colors, tolerance_m, lod),
+            "lines": [],
+            "markers": [(start, "green", "Start"), (end, "red", "End")],
+            "jobs": []
+        }
+
+    if "agents" in route_data and "jobs" in route_data:
+        points, job_markers, agent_markers = agents_and_jobs(route_data)
+        lines, job_markers = agent_routes(job_markers, agent_markers, solve, solve_max_jobs)
+        markers = []
+        for idx, am in enumerate(agent_markers):
+            if am["start"]:
+                markers.append((am["start"], "green", f"Agent {idx} start (cap={am.get('capacity')})"))
+            if am["end"]:
+                markers.append((am["end"], "red", f"Agent {idx} end"))
+        return {
+            "center": [sum(p[0] for p in points) / len(points), sum(p[1] for p in points) / len(points)],
+            "zoom": 14,
+            "levels": [],
+            "lines": lines,
+            "markers": markers,
+            "jobs": job_markers
+        }
+
+    raise ValueError("Unsupported route data format")
+
+def _geojson(layers):
+    # FeatureCollection of map_layers() with [lon, lat] coordinates quantized to
+    # POLYLINE_PRECISION decimals (~1 m)
+    def position(points):
+        return np.round(np.asarray(points, dtype=np.float64)[..., ::-1], POLYLINE_PRECISION).tolist()
+
+    def feature(kind, coordinates, properties):
+        return {"type": "Feature", "geometry": {"type": kind, "coordinates": coordinates}, "properties": properties}
+
+    features = []
+    for max_zoom, tol, runs in layers["levels"]:
+        for color, run in runs:
+            properties = {"color": color, "weight": 6, "opacity": 0.8, "toleranceM": tol}
+            if len(layers["levels"]) > 1:
+                properties["maxZoom"] = max_zoom
+            features.append(feature("LineString", position(run), properties))
+    for style, points, popup in layers["lines"]:
+        features.append(feature("LineString", position(points), dict(style, popup=popup) if popup else dict(style)))
+    for at, color, popup in layers["markers"]:
+        features.append(feature("Point", position(at), {"marker-color": color, "popup": popup}))
+    for jm in layers["jobs"]:
+        properties = {"pickup_amount": jm["pickup"], "duration": jm["duration"], "marker-color": jm["color"]}
+        if "agent" in jm:
+            properties["agent"] = jm["agent"]
+        features.append(feature("Point", position(jm["loc"]), properties))
+    return {"type": "FeatureCollection", "features": features}
+
+def build_light_map(route_data, out_path, tolerance_m=SIMPLIFY_TOLERANCE_M, lod=False, output="lite", solve=True,
+                    cluster_min_jobs=JOB_CLUSTER_MIN_JOBS, solve_max_jobs=SOLVE_MAX_JOBS):
+    # Write map_layers() as a static Leaflet page with encoded polylines decoded in the
+    # browser (output="lite") or as a quantized GeoJSON FeatureCollection ("geojson")
+    layers = map_layers(route_data, tolerance_m, lod, solve, solve_max_jobs)
+    if output == "geojson":
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump(_geojson(layers), f, ensure_ascii=False, separators=(",", ":"))
+        return out_path
+    if output != "lite":
+        raise ValueError(f"Unsupported output format: {output}")
+
+    data = {
+        "center": layers["center"],
+        "zoom": layers["zoom"],
+        "precision": POLYLINE_PRECISION,
+        "levels": [
+            {
+                "maxZoom": max_zoom,
+                "lines": [{"path": encode_polyline(run), "style": {"color": color, "weight": 6, "opacity": 0.8}}
+                          for color, run in runs]
+            }
+            for max_zoom, _, runs in layers["levels"]
+        ],
+        "lines": [{"path": encode_polyline(points), "style": style, "popup": popup} for style, points, popup in layers["lines"]],
+        "markers": [{"at": list(at), "color": color, "popup": popup} for at, color, popup in layers["markers"]]
+    }
+    if len(layers["jobs"]) >= cluster_min_jobs:
+        data["jobClusters"] = cluster_jobs(layers["jobs"])
+    elif layers["jobs"]:
+        data["jobs"] = dict(_job_data(layers["jobs"]), path=encode_polyline([jm["loc"] for jm in layers["jobs"]]))
+    page = (LITE_TEMPLATE
+            .replace("__LEAFLET_CSS__", LEAFLET_CSS)
+            .replace("__LEAFLET_JS__", LEAFLET_JS)
+            .replace("__SCRIPTS__", POLYLINE_DECODE_JS.strip() + ("\n" + JOB_CLUSTERS_JS.strip() if "jobClusters" in data else ""))
+            .replace("__DATA__", json.dumps(data, ensure_ascii=False, separators=(",", ":")).replace("</", "<\\/")))
+    with open(out_path, "w", encoding="utf-8") as f:
+        f.write(page)
+    return out_path
+
+def _batch_inputs(patterns):
+    # Expand directories (their *.json files) and globs into a sorted list of route files
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.update(glob.glob(os.path.join(pattern, "*.json")))
+        else:
+            paths.update(p for p in glob.glob(pattern, recursive=True) if os.path.isfile(p))
+    return sorted(paths)
+
+def _batch_outputs(inputs, out_dir, extension):
+    # Output path per input: next to it, or under out_dir mirroring its directory below the
+    # inputs' common directory. Inputs that differ only in extension (a.json, a.bin) keep it
+    # in their output name (a.json.html, a.bin.html)
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in inputs]) if out_dir else None
+    def output_path(path, keep_ext):
+        if out_dir:
+            directory = os.path.normpath(os.path.join(out_dir, os.path.relpath(os.path.dirname(os.path.abspath(path)), root)))
+        else:
+            directory = os.path.dirname(path) or "."
+        name = os.path.basename(path) if keep_ext else os.path.splitext(os.path.basename(path))[0]
+        return os.path.join(directory, name + extension)
+
+    outputs = {path: output_path(path, False) for path in inputs}
+    taken = Counter(outputs.values())
+    return {path: output_path(path, True) if taken[out] > 1 else out for path, out in outputs.items()}
+
+def _render_key(path, options):
+    # Content hash of the input plus everything that changes the rendered output
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    digest.update(json.dumps({"options": options, "version": RENDER_CACHE_VERSION}, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+def _render_file(path, out_html, options):
+    # Batch worker: load and render one file quietly; returns (seconds, error message or None)
+    started = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            build_map(load_route_data(path), out_html=out_html, **options)
+        return time.perf_counter() - started, None
+    except Exception as e:
+        return time.perf_counter() - started, str(e)
+
+def render_batch(patterns, out_dir=None, workers=None, force=False, **options):
+    # Render many route files across a process pool, skipping any whose input content and
+    # options match the cache entry of an existing output; prints a per-file summary
+    inputs = _batch_inputs(patterns)
+    if not inputs:
+        print("❌ No route files matched", ", ".join(patterns))
+        return []
+    started = time.perf_counter()
+
+    caches = {}
+    def cache_for(directory):
+        if directory not in caches:
+            try:
+                with open(os.path.join(directory, RENDER_CACHE_FILE), "r", encoding="utf-8") as f:
+                    caches[directory] = json.load(f)
+            except (OSError, ValueError):
+                caches[directory] = {}
+        return caches[directory]
+
+    results = []
+    pending = []
+    outputs = _batch_outputs(inputs, out_dir, OUTPUT_EXTENSIONS[options.get("output", "folium")])
+    taken = Counter(outputs.values())
+    for path in inputs:
+        out_html = outputs[path]
+        directory = os.path.dirname(out_html)
+        if taken[out_html] > 1:
+            # Still ambiguous (e.g. a.json next to a.json.json): render none of them rather than overwrite
+            results.append({"input": path, "output": out_html, "status": "failed", "seconds": 0.0,
+                            "error": f"output {out_html} collides with another input"})
+            continue
+        key = _render_key(path, options)
+        if not force and os.path.exists(out_html) and cache_for(directory).get(os.path.basename(out_html)) == key:
+            results.append({"input": path, "output": out_html, "status": "skipped", "seconds": 0.0})
+        else:
+            pending.append((path, out_html, key))
+
+    if pending:
+        if out_dir:
+            for directory in {os.path.dirname(out_html) for _, out_html, _ in pending}:
+                os.makedirs(directory, exist_ok=True)
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            futures = {pool.submit(_render_file, path, out_html, options): (path, out_html, key) for path, out_html, key in pending}
+            for future in as_completed(futures):
+                path, out_html, key = futures[future]
+                seconds, error = future.result()
+                cache = cache_for(os.path.dirname(out_html) or ".")
+                if error:
+                    cache.pop(os.path.basename(out_html), None)
+                    results.append({"input": path, "output": out_html, "status": "failed", "seconds": seconds, "error": error})
+                else:
+                    cache[os.path.basename(out_html)] = key
+                    results.append({"input": path, "output": out_html, "status": "rendered", "seconds": seconds})
+
+    for directory, cache in caches.items():
+        with open(os.path.join(directory, RENDER_CACHE_FILE), "w", encoding="utf-8") as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+
+    results.sort(key=lambda r: r["input"])
+    print(f"{'status':<10}{'seconds':>9}{'size KB':>10}  file")
+    for r in results:
+        size = os.path.getsize(r["output"]) / 1024 if r["status"] != "failed" and os.path.exists(r["output"]) else 0
+        print(f"{r['status']:<10}{r['seconds']:>9.2f}{size:>10.1f}  {r['input']}" + (f"  ({r['error']})" if r.get("error") else ""))
+    counts = {status: sum(r["status"] == status for r in results) for status in ("rendered", "skipped", "failed")}
+    print(f"✅ {counts['rendered']} rendered, ⏭️  {counts['skipped']} unchanged, ❌ {counts['failed']} failed "
+          f"in {time.perf_counter() - started:.2f}s")
+    return results
+
 def main():
+    parser = argparse.ArgumentParser(description="Render route data as an interactive map")
+    parser.add_argument("--input", default=DATA_FILE,
+                        help="route JSON (routeCoordinates, agents/jobs or routes) or a binary route file from --convert")
+    parser.add_argument("--out", help="file to write (default route_map.html, or route_map.geojson with --format geojson)")
+    parser.add_argument("--write-cleaned", nargs="?", const=os.path.join(os.path.dirname(__file__), "route_data_cleaned.json"),
+                        help="also write the extracted geometry as formatted JSON (default route_data_cleaned.json)")
+    parser.add_argument("--tolerance", type=float, default=SIMPLIFY_TOLERANCE_M,
+                        help="simplify route lines to this many meters before rendering (0 = keep every point)")
+    parser.add_argument("--lod", action="store_true", help="embed several simplification levels and switch them by zoom")
+    parser.add_argument("--no-solve", dest="solve", action="store_false",
+                        help="agents/jobs: draw straight start->end agent lines instead of planning tours")
+    parser.add_argument("--solve-max-jobs", type=int, default=SOLVE_MAX_JOBS,
+                        help="agents/jobs: plan tours only up to this many jobs; above it draw straight agent lines "
+                             "(planning memory grows with the square of the job count)")
+    parser.add_argument("--cluster-min-jobs", type=int, default=JOB_CLUSTER_MIN_JOBS,
+                        help="agents/jobs: draw jobs as zoom-dependent clusters from this many jobs on")
+    parser.add_argument("--format", choices=sorted(OUTPUT_EXTENSIONS), default="folium",
+                        help="folium HTML (default), a lite static page with encoded polylines, or quantized GeoJSON; "
+                             "lite and geojson do not import folium")
+    parser.add_argument("--convert", metavar="ROUTE_BIN",
+                        help="write --input's route line as a compact memory-mappable binary file and exit")
+    parser.add_argument("--polyline", action="store_true", help="with --convert, also store an encoded polyline")
+    parser.add_argument("--batch", nargs="+", metavar="PATH_OR_GLOB",
+                        help="render every matching route file (directories mean their *.json) to <name>.html")
+    parser.add_argument("--out-dir", help="with --batch, write maps here instead of next to each input, "
+                                              "in the same subdirectories the inputs have below their common directory")
+    parser.add_argument("--jobs", type=int, help="with --batch, worker processes (default: CPU count)")
+    parser.add_argument("--force", action="store_true", help="with --batch, re-render even when input and options are unchanged")
+    args = parser.parse_args()
+    if not args.out:
+        args.out = os.path.join(os.path.dirname(__file__), "route_map" + OUTPUT_EXTENSIONS[args.format])
+
+    if args.batch:
+        render_batch(args.batch, out_dir=args.out_dir, workers=args.jobs, force=args.force,
+                     tolerance_m=args.tolerance, lod=args.lod, output=args.format, solve=args.solve,
+                     cluster_min_jobs=args.cluster_min_jobs, solve_max_jobs=args.solve_max_jobs)
+        return
+
+    if args.convert:
+        try:
+            count = convert_route_file(args.input, args.convert, polyline=args.polyline)
+        except Exception as e:
+            print("❌ Failed to convert route data:", e)
+            return
+        print(f"✅ Binary route saved as {args.convert} ({count} points, {os.path.getsize(args.convert) / 1024:.1f} KB).")
+        return
+
     try:
-        route_data = load_route_data(DATA_FILE)
+        route_data = load_route_data(args.input)
     except Exception as e:
         print("❌ Failed to load route data:", e)
         return
 
-    # Optionally write a cleaned formatted copy
-    cleaned_path = os.path.join(os.path.dirname(__file__), "route_data_cleaned.json")
-    with open(cleaned_path, "w", encoding="utf-8") as f:
-        json.dump(route_data, f, indent=2, ensure_ascii=False)
+    # Optionally write a cleaned formatted copy (only the geometry the map uses)
+    if args.write_cleaned:
+        with open(args.write_cleaned, "w", encoding="utf-8") as f:
+            json.dump(route_data, f, indent=2, ensure_ascii=False, default=lambda a: a.tolist())
 
     try:
-        out = build_map(route_data, out_html=os.path.join(os.path.dirname(__file__), "route_map.html"))
-        print(f"✅ Map saved as {out}. Open it in your browser.")
-        print(f"✅ Cleaned JSON saved as {cleaned_path}.")
+        out = build_map(route_data, out_html=args.out, tolerance_m=args.tolerance, lod=args.lod, output=args.format,
+                        solve=args.solve, cluster_min_jobs=args.cluster_min_jobs, solve_max_jobs=args.solve_max_jobs)
+        if args.format == "geojson":
+            print(f"✅ GeoJSON saved as {out}.")
+        else:
+            print(f"✅ Map saved as {out}. Open it in your browser.")
+        if args.write_cleaned:
+            print(f"✅ Cleaned JSON saved as {args.write_cleaned}.")
     except Exception as e:
         print("❌ Failed to build map:", e)
 
@@ -0,0 +1,501 @@
+"""
+Offline benchmark for import_stations_with_amenities.py
+
+Starts a local fake Overpass server, writes a synthetic CSV of N stations and drives
+import_stations_from_csv and update_stations_with_empty_amenities against it, using
+either an in-process collection stand-in or a local mongod (--mongo-uri).
+
+    python scripts/benchmark_importer.py --stations 2000 --workers 8 --latency-ms 150 --rate-429 0.02
+
+Reports stations/sec, p50/p99 per-station fetch latency and peak memory, and can append
+the results (tagged with the current git commit) to a JSON lines file for comparison.
+"""
+import argparse
+import contextlib
+import copy
+import csv
+import io
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource  # Unix only
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import import_stations_with_amenities as importer
+from pymongo import InsertOne, UpdateOne
+
+# City centers the synthetic stations are scattered around (lat, lng)
+CITY_CENTERS = [
+    ('Delhi', 28.6139, 77.2090),
+    ('Mumbai', 19.0760, 72.8777),
+    ('Bengaluru', 12.9716, 77.5946),
+    ('Chennai', 13.0827, 80.2707),
+    ('Pune', 18.5204, 73.8567),
+    ('Indore', 22.7196, 75.8577),
+]
+
+AMENITY_TAGS = ['restaurant', 'cafe', 'fast_food', 'toilets', 'hospital', 'pharmacy', 'hotel', 'fuel', 'atm', 'bank', 'parking']
+
+AROUND_RE = re.compile(r'around:(\d+(?:\.\d+)?),(-?\d+(?:\.\d+)?),(-?\d+(?:\.\d+)?)')
+BBOX_RE = re.compile(r'\((-?\d+(?:\.\d+)?),(-?\d+(?:\.\d+)?),(-?\d+(?:\.\d+)?),(-?\d+(?:\.\d+)?)\)')
+
+class FakeOverpassHandler(BaseHTTPRequestHandler):
+    """Answers Overpass POSTs with synthetic (or canned) elements after a configurable delay"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        config = self.server.config
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        self.server.count('requests')
+
+        delay = max(0.0, random.gauss(config['latency'], config['latency'] * 0.25))
+        time.sleep(delay)
+
+        roll = random.random()
+        if roll < config['rate_429']:
+            self.server.count('429')
+            self._send(429, b'{"remark": "rate limited"}', {'Retry-After': str(config['retry_after'])})
+            return
+        if roll < config['rate_429'] + config['rate_5xx']:
+            self.server.count('5xx')
+            self._send(random.choice([502, 503, 504]), b'{"remark": "busy"}')
+            return
+
+        if config['canned'] is not None:
+            payload = config['canned']
+        else:
+            payload = json.dumps({'elements': synthetic_elements(body, config['density'])}).encode('utf-8')
+        self._send(200, payload)
+
+    def _send(self, status, payload, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeOverpassServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config):
+        super().__init__(('127.0.0.1', 0), FakeOverpassHandler)
+        self.config = config
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/api/interpreter"
+
+def synthetic_elements(query, density_per_km2):
+    """Deterministic fake amenities covering the query's around/bbox area"""
+    around = AROUND_RE.search(query)
+    if around:
+        radius, lat, lng = (float(v) for v in around.groups())
+        south, north = lat - radius / importer.METERS_PER_DEGREE, lat + radius / importer.METERS_PER_DEGREE
+        lng_pad = radius / (importer.METERS_PER_DEGREE * math.cos(math.radians(lat)))
+        west, east = lng - lng_pad, lng + lng_pad
+    else:
+        bbox = BBOX_RE.search(query)
+        if not bbox:
+            return []
+        south, west, north, east = (float(v) for v in bbox.groups())
+
+    height_km = (north - south) * importer.METERS_PER_DEGREE / 1000
+    width_km = (east - west) * importer.METERS_PER_DEGREE * math.cos(math.radians((north + south) / 2)) / 1000
+    count = min(20000, int(density_per_km2 * height_km * width_km))
+
+    rng = random.Random(query)
+    elements = []
+    for i in range(count):
+        element = {
+            'type': 'node',
+            'id': i,
+            'tags': {'amenity': rng.choice(AMENITY_TAGS), 'name': f'Amenity {i}'}
+        }
+        lat, lng = rng.uniform(south, north), rng.uniform(west, east)
+        if i % 5 == 0:
+            element['type'] = 'way'
+            element['center'] = {'lat': lat, 'lon': lng}
+        else:
+            element['lat'], element['lon'] = lat, lng
+        elements.append(element)
+    return elements
+
+def _matches(doc, query):
+    for key, value in query.items():
+        if key == '$or':
+            if not any(_matches(doc, sub) for sub in value):
+                return False
+        elif key == '$and':
+            if not all(_matches(doc, sub) for sub in value):
+                return False
+        elif isinstance(value, dict) and value and all(k.startswith('$') for k in value):
+            field = doc.get(key)
+            for op, arg in value.items():
+                if op == '$exists' and (key in doc) != arg:
+                    return False
+                if op == '$in' and field not in arg:
+                    return False
+                if op == '$ne' and field == arg:
+                    return False
+                if op in ('$gt', '$gte', '$lt', '$lte'):
+                    if field is None:
+                        return False
+                    if op == '$gt' and not field > arg:
+                        return False
+                    if op == '$gte' and not field >= arg:
+                        return False
+                    if op == '$lt' and not field < arg:
+                        return False
+                    if op == '$lte' and not field <= arg:
+                        return False
+        elif doc.get(key) != value:
+            return False
+    return True
+
+class InMemoryCursor(list):
+    def sort(self, key, direction=1):
+        if isinstance(key, list):
+            key, direction = key[0]
+        return InMemoryCursor(sorted(self, key=lambda d: (d.get(key) is None, d.get(key)), reverse=direction < 0))
+
+    def skip(self, n):
+        return InMemoryCursor(self[n:])
+
+    def limit(self, n):
+        return InMemoryCursor(self[:n] if n else self)
+
+    def batch_size(self, n):
+        return self
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class _BulkResult:
+    def __init__(self, inserted=0, matched=0, upserted=0):
+        self.inserted_count = inserted
+        self.matched_count = matched
+        self.modified_count = matched
+        self.upserted_count = upserted
+
+class InMemoryCollection:
+    """
+    In-process stand-in for the evstations collection
+    Covers only the query/update operators the importer uses, so runs measure the
+    importer itself rather than a database
+    """
+
+    def __init__(self):
+        self.docs = []
+        self.by_id = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def _insert(self, doc):
+        doc.setdefault('_id', self.next_id)
+        self.next_id += 1
+        self.docs.append(doc)
+        self.by_id[doc['_id']] = doc
+
+    def _find_docs(self, query):
+        if set(query) == {'_id'} and not isinstance(query['_id'], dict):
+            doc = self.by_id.get(query['_id'])
+            return [doc] if doc else []
+        return [d for d in self.docs if _matches(d, query)]
+
+    def _apply(self, doc, update):
+        for key, value in update.get('$set', {}).items():
+            doc[key] = copy.deepcopy(value)
+        for key in update.get('$unset', {}):
+            doc.pop(key, None)
+
+    def find(self, query=None, projection=None, **kwargs):
+        docs = self._find_docs(query or {})
+        if projection:
+            keys = [k for k, on in projection.items() if on] + ['_id']
+            docs = [{k: d[k] for k in keys if k in d} for d in docs]
+        return InMemoryCursor(docs)
+
+    def find_one(self, query=None, projection=None):
+        return next(iter(self.find(query, projection)), None)
+
+    def count_documents(self, query):
+        return len(self._find_docs(query))
+
+    def estimated_document_count(self):
+        return len(self.docs)
+
+    def create_index(self, *args, **kwargs):
+        return 'in-memory'
+
+    def insert_one(self, doc):
+        with self.lock:
+            self._insert(doc)
+
+    def update_many(self, query, update):
+        with self.lock:
+            for doc in self._find_docs(query):
+                self._apply(doc, update)
+
+    def update_one(self, query, update, upsert=False):
+        with self.lock:
+            self.bulk_write([UpdateOne(query, update, upsert=upsert)])
+
+    def bulk_write(self, ops, ordered=True):
+        inserted = matched = upserted = 0
+        with self.lock:
+            for op in ops:
+                if isinstance(op, InsertOne):
+                    self._insert(op._doc)
+                    inserted += 1
+                    continue
+                found = self._find_docs(op._filter)
+                if found:
+                    self._apply(found[0], op._doc)
+                    matched += 1
+                elif op._upsert:
+                    doc = {k: v for k, v in op._filter.items() if not k.startswith('$')}
+                    self._apply(doc, op._doc)
+                    for key, value in op._doc.get('$setOnInsert', {}).items():
+                        doc[key] = value
+                    self._insert(doc)
+                    upserted += 1
+        return _BulkResult(inserted, matched, upserted)
+
+    def drop(self):
+        self.docs, self.by_id = [], {}
+
+def write_synthetic_csv(path, stations, seed=42):
+    """CSV in the importer's input format, stations scattered within ~15km of a few cities"""
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'state', 'city', 'address', 'lattitude', 'longitude', 'type'])
+        for i in range(stations):
+            city, lat, lng = rng.choice(CITY_CENTERS)
+            writer.writerow([
+                f'Bench Station {i}',
+                'Bench',
+                city,
+                f'{i} Bench Road',
+                round(lat + rng.uniform(-0.13, 0.13), 6),
+                round(lng + rng.uniform(-0.13, 0.13), 6),
+                rng.choice(['7', '8', '10', '13', '15', '16'])
+            ])
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def max_rss_mb():
+    """Peak resident memory of this process in MB, or None when it can't be measured"""
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports ru_maxrss in KB, macOS in bytes
+        return round(max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memory = psutil.Process().memory_info()
+    # Windows tracks the peak working set; elsewhere fall back to the current RSS
+    return round(getattr(memory, 'peak_wset', memory.rss) / (1024 * 1024), 1)
+
+def run_phase(name, fn, verbose=False, trace_memory=False):
+    """
+    Run one importer entry point, returning timing, latency and memory figures
+    trace_memory adds tracemalloc's peak Python allocation, at a large cost in throughput
+    """
+    latencies = []
+    latency_lock = threading.Lock()
+    fetch_cluster = importer.fetch_amenities_for_cluster
+
+    def timed_fetch(points, radius_meters=2000):
+        start = time.perf_counter()
+        try:
+            return fetch_cluster(points, radius_meters)
+        finally:
+            elapsed = time.perf_counter() - start
+            with latency_lock:
+                # Every station of a cluster waits for the same request
+                latencies.extend([elapsed] * len(points))
+
+    importer.fetch_amenities_for_cluster = timed_fetch
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        with output:
+            result = fn()
+    finally:
+        elapsed = time.perf_counter() - start
+        peak = None
+        if trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        importer.fetch_amenities_for_cluster = fetch_cluster
+
+    report = importer.stats.report()
+    return {
+        'phase': name,
+        'seconds': round(elapsed, 3),
+        'stations': report['stations'],
+        'stationsPerSecond': round(report['stations'] / elapsed, 2) if elapsed else None,
+        'p50LatencyMs': round(1000 * percentile(latencies, 50), 2) if latencies else None,
+        'p99LatencyMs': round(1000 * percentile(latencies, 99), 2) if latencies else None,
+        'peakTracedMB': round(peak / 1e6, 2) if peak is not None else None,
+        'maxRssMB': max_rss_mb(),
+        'requests': report['requests'],
+        'retriesByReason': report['retriesByReason'],
+        'result': result,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the station importer against a local fake Overpass server")
+    parser.add_argument('--stations', type=int, default=500, help="synthetic stations in the CSV")
+    parser.add_argument('--workers', type=int, default=8, help="importer --workers")
+    parser.add_argument('--cluster', action='store_true', help="run the importer in cluster mode")
+    parser.add_argument('--latency-ms', type=float, default=100, help="mean fake Overpass latency")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument('--rate-5xx', type=float, default=0.0, help="fraction of requests answered with 502/503/504")
+    parser.add_argument('--retry-after', type=float, default=1, help="Retry-After seconds sent with 429s")
+    parser.add_argument('--density', type=float, default=15, help="synthetic amenities per km2")
+    parser.add_argument('--canned', help="replay this Overpass JSON response for every successful request")
+    parser.add_argument('--mirrors', type=int, default=1, help="number of fake Overpass mirrors to fail over between")
+    parser.add_argument('--overpass-rate', type=float, default=50, help="importer token bucket rate (requests/s)")
+    parser.add_argument('--sleep', type=float, default=0.0, help="IMPORT_SLEEP_SECONDS for sequential runs")
+    parser.add_argument('--backoff-base', type=float, default=1.2, help="OVERPASS_BACKOFF_BASE during the benchmark")
+    parser.add_argument('--mongo-uri', help="use this mongod (a scratch 'routewise_bench' database) instead of the in-process stand-in")
+    parser.add_argument('--phases', default='import,update-empty', help="comma-separated phases to run")
+    parser.add_argument('--output', help="append the results as one JSON line to this file")
+    parser.add_argument('--trace-memory', action='store_true', help="also measure peak Python allocations with tracemalloc (slow)")
+    parser.add_argument('--verbose', action='store_true', help="show the importer's own output")
+    args = parser.parse_args()
+
+    canned = None
+    if args.canned:
+        with open(args.canned, 'rb') as f:
+            canned = f.read()
+
+    servers = []
+    for _ in range(max(1, args.mirrors)):
+        server = FakeOverpassServer({
+            'latency': args.latency_ms / 1000,
+            'rate_429': args.rate_429,
+            'rate_5xx': args.rate_5xx,
+            'retry_after': args.retry_after,
+            'density': args.density,
+            'canned': canned,
+        })
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+
+    # Point the importer at the fake mirrors with no cache and benchmark pacing
+    importer.overpass_mirrors = importer.MirrorPool([s.url for s in servers])
+    importer.IMPORT_SLEEP_SECONDS = args.sleep
+    importer.BACKOFF_BASE = args.backoff_base
+    importer.rate_limiter = importer.TokenBucket(args.overpass_rate, max(1, args.workers))
+    importer.overpass_cache.enabled = False
+
+    if args.mongo_uri:
+        from pymongo import MongoClient
+        target = MongoClient(args.mongo_uri)['routewise_bench']['evstations']
+        target.drop()
+    else:
+        target = InMemoryCollection()
+    importer.collection = target
+
+    workdir = tempfile.mkdtemp(prefix='routewise-bench-')
+    csv_path = os.path.join(workdir, 'stations.csv')
+    write_synthetic_csv(csv_path, args.stations)
+
+    print(f"🏁 Benchmark: {args.stations} stations, workers={args.workers}, cluster={args.cluster}, "
+          f"latency={args.latency_ms}ms, mirrors={args.mirrors}, 429={args.rate_429}, 5xx={args.rate_5xx}, "
+          f"db={'mongod' if args.mongo_uri else 'in-process'}")
+
+    phases = [p.strip() for p in args.phases.split(',') if p.strip()]
+    results = []
+    for phase in phases:
+        if phase == 'import':
+            fn = lambda: importer.import_stations_from_csv(
+                csv_path, cluster=args.cluster, workers=args.workers,
+                checkpoint_path=os.path.join(workdir, 'stations.checkpoint.json'))
+        elif phase == 'update-empty':
+            # Re-run enrichment for every station the import phase wrote
+            target.update_many({}, {'$set': {'amenities': []}})
+            fn = lambda: importer.update_stations_with_empty_amenities(cluster=args.cluster, workers=args.workers)
+        else:
+            parser.error(f"unknown phase '{phase}'")
+        results.append(run_phase(phase, fn, verbose=args.verbose, trace_memory=args.trace_memory))
+
+    server_counts = {}
+    for server in servers:
+        server.shutdown()
+        for key, value in server.counts.items():
+            server_counts[key] = server_counts.get(key, 0) + value
+
+    print(f"\n{'phase':<14}{'stations':>10}{'seconds':>10}{'st/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'rss MB':>10}{'traced MB':>11}{'requests':>10}")
+    for r in results:
+        print(f"{r['phase']:<14}{r['stations']:>10}{r['seconds']:>10}{r['stationsPerSecond'] or 0:>10}"
+              f"{r['p50LatencyMs'] or 0:>10}{r['p99LatencyMs'] or 0:>10}{r['maxRssMB'] if r['maxRssMB'] is not None else '-':>10}"
+              f"{r['peakTracedMB'] if r['peakTracedMB'] is not None else '-':>11}{r['requests']:>10}")
+    max_rss = max_rss_mb()
+    print(f"\nServer: {server_counts} | process max RSS {f'{max_rss}MB' if max_rss is not None else 'unavailable (pip install psutil)'}")
+
+    if args.output:
+        record = {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': vars(args),
+            'maxRssMB': max_rss,
+            'server': server_counts,
+            'phases': results,
+        }
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+        print(f"📈 Results appended to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+"""
+Precomputed spatial index of EV stations for fast corridor lookups
+
+Exports the evstations collection into one compact binary file whose arrays are
+memory-mapped on load: station coordinates, ids and power ratings sorted by grid
+cell, plus the cell offsets needed to find every station in a cell.
+
+    python scripts/build_station_index.py build
+    python scripts/build_station_index.py query --route scripts/route_data.json --radius-km 5
+
+The query side never touches MongoDB. It collects the grid cells within the radius
+of the route, pulls the stations in those cells and keeps the ones whose distance to
+the polyline is within the radius, ordered by how far along the route they are.
+"""
+import argparse
+import json
+import math
+import os
+import struct
+import time
+from datetime import datetime
+
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+INDEX_PATH = os.getenv('STATION_INDEX_PATH', os.path.join(SCRIPT_DIR, 'station_index.bin'))
+INDEX_CELL_DEG = float(os.getenv('STATION_INDEX_CELL_DEG', '0.1'))  # grid cell size (~11km of latitude)
+
+MAGIC = b'RWSTIDX1'
+ALIGN = 16
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+
+def _cell_ids(lats, lngs, header):
+    """Row-major grid cell of each point"""
+    rows = np.floor((np.asarray(lats, dtype=np.float64) - header['latMin']) / header['cellDeg']).astype(np.int64)
+    cols = np.floor((np.asarray(lngs, dtype=np.float64) - header['lngMin']) / header['cellDeg']).astype(np.int64)
+    return rows * header['nCols'] + cols
+
+def build_index(stations, path=None, cell_deg=None, source=None):
+    """
+    Write the index file for an iterable of station dicts with _id, latitude,
+    longitude and powerKw; returns the number of stations indexed
+    """
+    path = path or INDEX_PATH
+    cell_deg = cell_deg or INDEX_CELL_DEG
+
+    ids, lats, lngs, power = [], [], [], []
+    for station in stations:
+        lat, lng = station.get('latitude'), station.get('longitude')
+        if not isinstance(lat, (int, float)) or not isinstance(lng, (int, float)) or not (lat or lng):
+            continue
+        ids.append(str(station['_id']).encode('utf-8'))
+        lats.append(lat)
+        lngs.append(lng)
+        power.append(station.get('powerKw') or 0)
+
+    lats = np.array(lats, dtype=np.float64)
+    lngs = np.array(lngs, dtype=np.float64)
+    header = {
+        'version': 1,
+        'count': len(ids),
+        'cellDeg': cell_deg,
+        # Cells are counted from a grid-aligned corner so ids stay stable across rebuilds
+        'latMin': math.floor(lats.min() / cell_deg) * cell_deg if len(ids) else 0.0,
+        'lngMin': math.floor(lngs.min() / cell_deg) * cell_deg if len(ids) else 0.0,
+        'builtAt': datetime.utcnow().isoformat() + 'Z',
+        'source': source
+    }
+    header['nCols'] = int(math.floor((lngs.max() - header['lngMin']) / cell_deg)) + 1 if len(ids) else 1
+
+    cells = _cell_ids(lats, lngs, header)
+    order = np.argsort(cells, kind='stable')
+    cells = cells[order]
+    unique_cells, starts = np.unique(cells, return_index=True)
+
+    arrays = {
+        'cells': unique_cells.astype(np.int64),
+        'starts': np.append(starts, len(cells)).astype(np.int64),
+        'lat': lats[order].astype(np.float32),
+        'lng': lngs[order].astype(np.float32),
+        'powerKw': np.array(power, dtype=np.float32)[order],
+        'ids': np.array(ids, dtype=f"S{max((len(i) for i in ids), default=1)}")[order]
+    }
+
+    # Lay arrays out after the header on ALIGN-byte boundaries
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    header['arrays'] = layout
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 4 + len(header_bytes)) // ALIGN) * ALIGN
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+    return header['count']
+
+def export_from_mongo(path=None, cell_deg=None):
+    """Build the index from operational stations in MongoDB (MONGO_URI)"""
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    load_dotenv()
+    client = MongoClient(os.getenv('MONGO_URI', 'mongodb://localhost:27017/routewise'))
+    collection = client['routewise']['evstations']
+    projection = {'_id': 1, 'latitude': 1, 'longitude': 1, 'powerKw': 1}
+    with collection.find({'isOperational': {'$ne': False}}, projection) as cursor:
+        return build_index(cursor, path, cell_deg, source='mongodb:routewise.evstations')
+
+class StationIndex:
+    """Read-only, memory-mapped view of an index file written by build_index"""
+
+    def __init__(self, path=None):
+        self.path = path or INDEX_PATH
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"Not a station index file: {self.path}")
+            header_len = struct.unpack('<I', f.read(4))[0]
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+        data_start = -(-(len(MAGIC) + 4 + header_len) // ALIGN) * ALIGN
+
+        for name, spec in self.header['arrays'].items():
+            shape = tuple(spec['shape'])
+            if shape[0] == 0:
+                array = np.empty(shape, dtype=np.dtype(spec['dtype']))
+            else:
+                array = np.memmap(self.path, dtype=np.dtype(spec['dtype']), mode='r',
+                                  offset=data_start + spec['offset'], shape=shape)
+            setattr(self, name, array)
+
+    def __len__(self):
+        return self.header['count']
+
+    def _rows_in_cells(self, cell_ids):
+        """Row indices of the stations in the given grid cells"""
+        positions = np.minimum(np.searchsorted(self.cells, cell_ids), len(self.cells) - 1)
+        positions = positions[self.cells[positions] == cell_ids]
+        if not len(positions):
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(self.starts[p], self.starts[p + 1]) for p in positions])
+
+    def _corridor_cells(self, route, radius_km):
+        """Grid cells within radius_km of any point on the route"""
+        cell = self.header['cellDeg']
+        # Sample segments at most half a cell apart so no crossed cell is missed
+        deltas = route[1:] - route[:-1]
+        steps = np.maximum(1, np.ceil(np.abs(deltas).max(axis=1, initial=0) / (cell / 2))).astype(np.int64)
+        segment = np.repeat(np.arange(len(deltas)), steps)
+        fraction = (np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)) / np.repeat(steps, steps)
+        samples = np.vstack([route[segment] + deltas[segment] * fraction[:, None], route[-1:]])
+
+        lat_pad = radius_km / KM_PER_DEGREE
+        lng_pad = radius_km / (KM_PER_DEGREE * max(0.01, np.cos(np.radians(np.abs(samples[:, 0]).max()))))
+        row_span = int(np.ceil(lat_pad / cell))
+        col_span = int(np.ceil(lng_pad / cell))
+
+        rows = np.floor((samples[:, 0] - self.header['latMin']) / cell).astype(np.int64)
+        cols = np.floor((samples[:, 1] - self.header['lngMin']) / cell).astype(np.int64)
+        dr, dc = np.meshgrid(np.arange(-row_span, row_span + 1), np.arange(-col_span, col_span + 1), indexing='ij')
+        rows = (rows[:, None] + dr.ravel()[None, :]).ravel()
+        cols = (cols[:, None] + dc.ravel()[None, :]).ravel()
+        valid = (cols >= 0) & (cols < self.header['nCols']) & (rows >= 0)
+        return np.unique(rows[valid] * self.header['nCols'] + cols[valid])
+
+    def along_route(self, route, radius_km=5.0, min_power_kw=None):
+        """
+        Stations within radius_km of a route polyline given as (lat, lng) pairs
+        Returns dicts with id, lat, lng, powerKw, distanceKm (to the route) and
+        routeKm (position along the route), ordered by routeKm
+        """
+        route = np.asarray(route, dtype=np.float64).reshape(-1, 2)
+        if not len(route) or not len(self):
+            return []
+
+        rows = self._rows_in_cells(self._corridor_cells(route, radius_km))
+        if min_power_kw:
+            rows = rows[self.powerKw[rows] >= min_power_kw]
+        if not len(rows):
+            return []
+
+        distance_km, route_km = _distance_to_polyline(
+            self.lat[rows].astype(np.float64), self.lng[rows].astype(np.float64), route, radius_km)
+        keep = distance_km <= radius_km
+        rows, distance_km, route_km = rows[keep], distance_km[keep], route_km[keep]
+        order = np.argsort(route_km, kind='stable')
+
+        return [
+            {
+                'id': self.ids[r].decode('utf-8'),
+                'lat': float(self.lat[r]),
+                'lng': float(self.lng[r]),
+                'powerKw': float(self.powerKw[r]),
+                'distanceKm': round(float(d), 3),
+                'routeKm': round(float(k), 3)
+            }
+            for r, d, k in zip(rows[order], distance_km[order], route_km[order])
+        ]
+
+def _distance_to_polyline(lats, lngs, route, radius_km=None, chunk_segments=64):
+    """
+    Distance (km) from each point to the nearest segment of route, and the
+    along-route position (km) of that nearest point
+    Uses a local equirectangular projection around each point, which is accurate
+    at corridor scale. The route is walked in chunks of segments; with radius_km
+    only points inside a chunk's padded bounding box are measured against it,
+    and points further than radius_km from every chunk come back as inf
+    """
+    if len(route) == 1:
+        route = np.vstack([route, route])
+    a, b = route[:-1], route[1:]
+    rad = np.radians
+
+    # Segment lengths (haversine) for the along-route position
+    dlat, dlng = rad(b[:, 0] - a[:, 0]), rad(b[:, 1] - a[:, 1])
+    h = np.sin(dlat / 2) ** 2 + np.cos(rad(a[:, 0])) * np.cos(rad(b[:, 0])) * np.sin(dlng / 2) ** 2
+    seg_km = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(1.0, h)))
+    seg_start_km = np.concatenate([[0.0], np.cumsum(seg_km)[:-1]])
+
+    distance_km = np.full(len(lats), np.inf)
+    route_km = np.zeros(len(lats))
+    if radius_km is not None:
+        pad = np.array([radius_km / KM_PER_DEGREE,
+                        radius_km / (KM_PER_DEGREE * max(0.01, np.cos(rad(np.abs(route[:, 0]).max()))))])
+
+    for start in range(0, len(a), chunk_segments):
+        sa, sb = a[start:start + chunk_segments], b[start:start + chunk_segments]
+        if radius_km is None:
+            picked = np.arange(len(lats))
+        else:
+            lo = np.minimum(sa.min(axis=0), sb.min(axis=0)) - pad
+            hi = np.maximum(sa.max(axis=0), sb.max(axis=0)) + pad
+            picked = np.nonzero((lats >= lo[0]) & (lats <= hi[0]) & (lngs >= lo[1]) & (lngs <= hi[1]))[0]
+            if not len(picked):
+                continue
+
+        plat, plng = lats[picked, None], lngs[picked, None]
+        scale = np.cos(rad(plat)) * KM_PER_DEGREE
+        # Segment endpoints relative to each point, in km
+        ax, ay = (sa[None, :, 1] - plng) * scale, (sa[None, :, 0] - plat) * KM_PER_DEGREE
+        bx, by = (sb[None, :, 1] - plng) * scale, (sb[None, :, 0] - plat) * KM_PER_DEGREE
+        dx, dy = bx - ax, by - ay
+        length2 = dx * dx + dy * dy
+        t = np.clip(-(ax * dx + ay * dy) / np.where(length2 > 0, length2, 1), 0, 1)
+        dist = np.hypot(ax + t * dx, ay + t * dy)
+
+        nearest = dist.argmin(axis=1)
+        rows = np.arange(len(picked))
+        best = dist[rows, nearest]
+        closer = best < distance_km[picked]
+        segment = start + nearest[closer]
+        distance_km[picked[closer]] = best[closer]
+        route_km[picked[closer]] = seg_start_km[segment] + t[rows, nearest][closer] * seg_km[segment]
+    return distance_km, route_km
+
+def load_route(path):
+    """
+    (lat, lng) array from a route JSON: OSRM/Mapbox `routes` (overview geometry,
+    else step geometries) or `routeCoordinates` [{lat, lng}, ...]
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    if 'routeCoordinates' in data:
+        return np.array([(float(p['lat']), float(p['lng'])) for p in data['routeCoordinates']])
+
+    route = (data.get('routes') or [{}])[0]
+    geometry = route.get('geometry')
+    if isinstance(geometry, dict) and geometry.get('coordinates'):
+        coords = geometry['coordinates']
+    else:
+        coords = []
+        for leg in route.get('legs', []):
+            for step in leg.get('steps', []):
+                step_coords = (step.get('geometry') or {}).get('coordinates') or []
+                # Consecutive steps share their boundary point
+                coords.extend(step_coords[1:] if coords and step_coords and step_coords[0] == coords[-1] else step_coords)
+    if not coords:
+        raise ValueError(f"No route geometry found in {path}")
+    return np.array([(float(c[1]), float(c[0])) for c in coords])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the memory-mapped EV station spatial index")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    build = sub.add_parser('build', help="export stations from MongoDB into the index file")
+    build.add_argument('--out', default=INDEX_PATH, help="index file to write (STATION_INDEX_PATH)")
+    build.add_argument('--cell-deg', type=float, default=INDEX_CELL_DEG, help="grid cell size in degrees")
+
+    query = sub.add_parser('query', help="list candidate stations along a route")
+    query.add_argument('--index', default=INDEX_PATH, help="index file to read")
+    query.add_argument('--route', default=os.path.join(SCRIPT_DIR, 'route_data.json'), help="route JSON (routes or routeCoordinates)")
+    query.add_argument('--radius-km', type=float, default=5.0, help="corridor half-width in km")
+    query.add_argument('--min-power', type=float, help="only stations with at least this powerKw")
+    query.add_argument('--json', action='store_true', help="print the full result as JSON")
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        started = time.perf_counter()
+        count = export_from_mongo(args.out, args.cell_deg)
+        print(f"✅ Indexed {count} stations into {args.out} "
+              f"({os.path.getsize(args.out) / 1024:.1f}KB) in {time.perf_counter() - started:.2f}s")
+    else:
+        route = load_route(args.route)
+        started = time.perf_counter()
+        index = StationIndex(args.index)
+        stations = index.along_route(route, args.radius_km, args.min_power)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if args.json:
+            print(json.dumps(stations, indent=2))
+        else:
+            print(f"🛣️  Route: {len(route)} points | index: {len(index)} stations")
+            print(f"⚡ {len(stations)} stations within {args.radius_km}km in {elapsed_ms:.1f}ms")
+            for s in stations[:20]:
+                print(f"  {s['routeKm']:>8.1f}km  {s['distanceKm']:>6.2f}km off-route  {s['powerKw']:>5.0f}kW  {s['id']}")
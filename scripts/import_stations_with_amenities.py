@@ -1,12 +1,23 @@
 import csv
 import requests
 import time
-from pymongo import MongoClient
-from datetime import datetime
+from pymongo import MongoClient, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from datetime import datetime, timedelta
 import os
 from dotenv import load_dotenv
 import random
-import re  # added for case-insensitive DB name lookup
+import re
+import math
+import threading
+from concurrent import futures
+import sqlite3
+import zlib
+import json
+import hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
 
 # Load environment variables
 load_dotenv()
@@ -16,9 +27,14 @@ MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017/routewise')
 client = MongoClient(MONGO_URI)
 db = client['routewise']
 collection = db['evstations']
+amenity_details = db['stationamenities']  # full amenity lists when AMENITY_DETAIL_MODE=separate
 
-# OpenStreetMap Overpass API
+# OpenStreetMap Overpass API (primary endpoint, plus mirrors to fail over to)
 OVERPASS_URL = "https://overpass-api.de/api/interpreter"
+OVERPASS_URLS = [u.strip() for u in os.getenv('OVERPASS_URLS', f"{OVERPASS_URL},https://overpass.kumi.systems/api/interpreter").split(',') if u.strip()]
+OVERPASS_POOL_SIZE = int(os.getenv('OVERPASS_POOL_SIZE', '32'))  # keep-alive connections per mirror
+MIRROR_COOLDOWN_SECONDS = float(os.getenv('OVERPASS_MIRROR_COOLDOWN', '30'))
+MIRROR_COOLDOWN_MAX_SECONDS = 600
 
 # Configurable retry settings
 OVERPASS_TIMEOUT = int(os.getenv('OVERPASS_TIMEOUT', '60'))
@@ -26,77 +42,434 @@ OVERPASS_MAX_RETRIES = int(os.getenv('OVERPASS_MAX_RETRIES', '5'))
 BACKOFF_BASE = float(os.getenv('OVERPASS_BACKOFF_BASE', '3'))
 IMPORT_SLEEP_SECONDS = float(os.getenv('IMPORT_SLEEP_SECONDS', '5'))
 
-def fetch_amenities_from_osm(lat, lng, radius_meters=2000):
+# Cluster mode: stations sharing a grid tile are enriched with one bbox query
+CLUSTER_CELL_METERS = float(os.getenv('CLUSTER_CELL_METERS', '3000'))
+CLUSTER_BATCH_SIZE = int(os.getenv('CLUSTER_BATCH_SIZE', '500'))
+
+# Concurrent mode: number of Overpass requests in flight, paced by a shared token bucket
+OVERPASS_WORKERS = int(os.getenv('OVERPASS_WORKERS', '1'))
+OVERPASS_RATE = float(os.getenv('OVERPASS_RATE', '1'))  # requests per second at full speed
+OVERPASS_BURST = float(os.getenv('OVERPASS_BURST', '2'))
+
+# Bulk MongoDB writes: flush when this many ops are buffered or the oldest is this old
+MONGO_BATCH_SIZE = int(os.getenv('MONGO_BATCH_SIZE', '200'))
+MONGO_FLUSH_SECONDS = float(os.getenv('MONGO_FLUSH_SECONDS', '5'))
+
+# Duplicate detection: by name only (case-insensitive), or name + rounded coordinates
+DEDUP_BY_COORDS = os.getenv('DEDUP_BY_COORDS', '0') == '1'
+DEDUP_COORD_PRECISION = int(os.getenv('DEDUP_COORD_PRECISION', '4'))  # ~11m
+
+# Resumable imports: how often the committed CSV position is persisted
+CHECKPOINT_SECONDS = float(os.getenv('CHECKPOINT_SECONDS', '10'))
+STATION_KEY_PRECISION = 5  # coordinate decimals in the stable station identity
+
+# Stale refresh: stations whose amenities were fetched longer ago than this are re-fetched
+REFRESH_MAX_AGE_DAYS = float(os.getenv('REFRESH_MAX_AGE_DAYS', '30'))
+REFRESH_BUDGET = int(os.getenv('REFRESH_BUDGET', '500'))  # stations re-fetched per run
+
+# Station documents carry a per-category amenitiesSummary; the full amenitiesDetail list
+# stays on the station (inline), moves to the stationamenities collection (separate) or is dropped
+AMENITY_TOP_K = int(os.getenv('AMENITY_TOP_K', '3'))  # nearest entries kept per category
+AMENITY_DETAIL_MODE = os.getenv('AMENITY_DETAIL_MODE', 'inline')
+
+# --backfill-location: stations migrated per batch
+LOCATION_BACKFILL_BATCH = int(os.getenv('LOCATION_BACKFILL_BATCH', '1000'))
+
+# Local cache of Overpass results so reruns are served from disk
+OVERPASS_CACHE_PATH = os.getenv('OVERPASS_CACHE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.overpass_cache.sqlite'))
+OVERPASS_CACHE_TTL_HOURS = float(os.getenv('OVERPASS_CACHE_TTL_HOURS', '168'))
+OVERPASS_CACHE_MAX_MB = float(os.getenv('OVERPASS_CACHE_MAX_MB', '256'))
+OVERPASS_CACHE_PRECISION = int(os.getenv('OVERPASS_CACHE_PRECISION', '5'))  # decimals kept in query coordinates (~1m)
+
+METERS_PER_DEGREE = 111320
+
+class RunStats:
     """
-    Fetch ALL amenities near a location using OpenStreetMap Overpass API
-    with retry logic for 429 and 504 errors
-    Returns a list of ALL amenities with their types and distances
+    Thread-safe per-stage timers and counters for one importer run
+    Stage seconds are summed across worker threads, so with --workers > 1
+    they can add up to more than the wall-clock time
     """
-    print(f"  Fetching amenities for ({lat}, {lng})...")
     
-    query = f"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.progress_every = 0
+        self.reset()
+    
+    def reset(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.started_at = datetime.utcnow()
+            self.last_progress = self.started
+            self.stage_seconds = {}
+            self.stage_calls = {}
+            self.counters = {}
+    
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+    
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+            self.stage_calls[stage] = self.stage_calls.get(stage, 0) + 1
+    
+    def incr(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+    
+    def elapsed(self):
+        return time.monotonic() - self.started
+    
+    def progress(self, force=False):
+        """Print a one-line progress summary every progress_every seconds"""
+        if not self.progress_every and not force:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_progress < self.progress_every:
+            return
+        self.last_progress = now
+        
+        elapsed = self.elapsed()
+        c = self.counters
+        retries = sum(v for k, v in c.items() if k.startswith('retries.'))
+        print(f"⏱️  {elapsed:.0f}s | {c.get('stations', 0)} stations ({c.get('stations', 0) / max(elapsed, 1e-9):.2f}/s) | "
+              f"{c.get('requests', 0)} requests, {retries} retries | {c.get('bytesReceived', 0) / 1e6:.1f}MB | "
+              f"sleeping {self.stage_seconds.get('backoff_sleep', 0.0) + self.stage_seconds.get('pacing_sleep', 0.0):.0f}s | "
+              f"db {self.stage_seconds.get('db_write', 0.0):.1f}s")
+    
+    def report(self, **extra):
+        """Machine-readable summary of the run"""
+        elapsed = self.elapsed()
+        with self.lock:
+            stages = {
+                stage: {'seconds': round(seconds, 4), 'calls': self.stage_calls[stage]}
+                for stage, seconds in sorted(self.stage_seconds.items())
+            }
+            counters = dict(sorted(self.counters.items()))
+        
+        db = stages.get('db_write')
+        report = {
+            'startedAt': self.started_at.isoformat(),
+            'elapsedSeconds': round(elapsed, 3),
+            'stations': counters.get('stations', 0),
+            'stationsPerSecond': round(counters.get('stations', 0) / elapsed, 3) if elapsed else 0.0,
+            'requests': counters.get('requests', 0),
+            'retriesByReason': {k.split('.', 1)[1]: v for k, v in counters.items() if k.startswith('retries.')},
+            'httpStatus': {k.split('.', 1)[1]: v for k, v in counters.items() if k.startswith('http.')},
+            'bytesReceived': counters.get('bytesReceived', 0),
+            'sleepSeconds': round(sum(stages.get(s, {}).get('seconds', 0.0) for s in ('backoff_sleep', 'pacing_sleep', 'rate_limit_wait')), 3),
+            'dbWriteLatencyMs': round(1000 * db['seconds'] / db['calls'], 2) if db else None,
+            'stages': stages,
+            'counters': counters,
+            'mirrors': {
+                url: {
+                    'requests': overpass_mirrors.requests[url],
+                    'latencyMs': None if overpass_mirrors.latency[url] is None else round(overpass_mirrors.latency[url] * 1000, 1)
+                }
+                for url in overpass_mirrors.urls
+            },
+            'cache': {
+                'hits': overpass_cache.hits,
+                'misses': overpass_cache.misses,
+                'expired': overpass_cache.expired,
+                'evictions': overpass_cache.evictions
+            }
+        }
+        report.update(extra)
+        return report
+    
+    def write_report(self, path, **extra):
+        report = self.report(**extra)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        return report
+
+stats = RunStats()
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by every Overpass request
+    Halves its rate on 429/504 (and pauses everyone for Retry-After),
+    then creeps back towards the configured rate on each success
+    """
+    
+    def __init__(self, rate, burst=1):
+        self.max_rate = rate
+        self.min_rate = rate / 16
+        self.rate = rate
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            stats.add_time('rate_limit_wait', delay)
+            time.sleep(delay)
+    
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+    
+    def on_overload(self, retry_after=None):
+        """Back off after a 429/504; retry_after pauses all workers for that many seconds"""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                self.updated = self.paused_until
+                self.tokens = 0.0
+
+rate_limiter = TokenBucket(OVERPASS_RATE, OVERPASS_BURST)
+
+class MirrorPool:
+    """
+    Overpass endpoints with simple health tracking
+    Each request goes to the healthy mirror with the lowest smoothed latency (untried
+    mirrors first). A mirror that answers 429/5xx or times out cools down for its
+    Retry-After, or a period doubling with each consecutive failure
+    """
+    
+    def __init__(self, urls):
+        self.urls = list(urls)
+        self.latency = {url: None for url in self.urls}
+        self.failures = {url: 0 for url in self.urls}
+        self.down_until = {url: 0.0 for url in self.urls}
+        self.requests = {url: 0 for url in self.urls}
+        self.lock = threading.Lock()
+    
+    def choose(self):
+        with self.lock:
+            now = time.monotonic()
+            healthy = [u for u in self.urls if self.down_until[u] <= now]
+            if healthy:
+                url = min(healthy, key=lambda u: (self.latency[u] is not None, self.latency[u] or 0.0))
+            else:
+                # Everyone is cooling down; use whichever recovers first
+                url = min(self.urls, key=lambda u: self.down_until[u])
+            self.requests[url] += 1
+            return url
+    
+    def report_success(self, url, seconds):
+        with self.lock:
+            previous = self.latency[url]
+            self.latency[url] = seconds if previous is None else 0.3 * seconds + 0.7 * previous
+            self.failures[url] = 0
+            self.down_until[url] = 0.0
+    
+    def report_failure(self, url, cooldown=None):
+        """Put a mirror in cooldown; returns True if another mirror is healthy right now"""
+        with self.lock:
+            now = time.monotonic()
+            self.failures[url] += 1
+            if not cooldown:
+                cooldown = min(MIRROR_COOLDOWN_MAX_SECONDS, MIRROR_COOLDOWN_SECONDS * 2 ** (self.failures[url] - 1))
+            self.down_until[url] = now + cooldown
+            return any(self.down_until[u] <= now for u in self.urls if u != url)
+    
+    def summary(self):
+        with self.lock:
+            parts = []
+            for url in self.urls:
+                latency = self.latency[url]
+                parts.append(f"{url.split('/')[2]}: {self.requests[url]} requests, "
+                             f"{'-' if latency is None else f'{latency * 1000:.0f}ms'}")
+            return '; '.join(parts)
+
+overpass_mirrors = MirrorPool(OVERPASS_URLS)
+
+def _make_http_session(pool_size):
+    """One keep-alive session shared by every worker thread, with gzip negotiated"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max(1, len(OVERPASS_URLS)), pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Content-Type': 'text/plain'})
+    return session
+
+http_session = _make_http_session(OVERPASS_POOL_SIZE)
+
+class OverpassCache:
+    """
+    SQLite file cache of parsed Overpass elements, keyed by the query area and amenity filter
+    Payloads are zlib-compressed JSON; entries expire after ttl_seconds and the
+    least recently used ones are evicted once the file holds more than max_bytes
+    """
+    
+    def __init__(self, path, ttl_seconds, max_bytes):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self._conn = None
+        self._total_bytes = 0
+    
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS overpass_cache ("
+                "key TEXT PRIMARY KEY, payload BLOB NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS overpass_cache_accessed ON overpass_cache (accessed)")
+            self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM overpass_cache").fetchone()[0]
+        return self._conn
+    
+    @staticmethod
+    def make_key(area):
+        return hashlib.sha1(f"{area}|{AMENITY_FILTER}".encode('utf-8')).hexdigest()
+    
+    def get(self, area):
+        """Return cached parsed elements for an area, or None on a miss"""
+        if not self.enabled:
+            return None
+        key = self.make_key(area)
+        now = time.time()
+        with self.lock:
+            db = self._db()
+            row = db.execute("SELECT payload, size, created FROM overpass_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            payload, size, created = row
+            if now - created > self.ttl_seconds:
+                db.execute("DELETE FROM overpass_cache WHERE key = ?", (key,))
+                db.commit()
+                self._total_bytes -= size
+                self.expired += 1
+                self.misses += 1
+                return None
+            db.execute("UPDATE overpass_cache SET accessed = ? WHERE key = ?", (now, key))
+            db.commit()
+            self.hits += 1
+        return [tuple(e) for e in json.loads(zlib.decompress(payload))]
+    
+    def put(self, area, parsed_elements):
+        if not self.enabled:
+            return
+        key = self.make_key(area)
+        payload = zlib.compress(json.dumps(parsed_elements, separators=(',', ':')).encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            db = self._db()
+            old = db.execute("SELECT size FROM overpass_cache WHERE key = ?", (key,)).fetchone()
+            if old:
+                self._total_bytes -= old[0]
+            db.execute(
+                "INSERT OR REPLACE INTO overpass_cache (key, payload, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, len(payload), now, now)
+            )
+            self._total_bytes += len(payload)
+            
+            # Evict least recently used entries until under the size limit
+            while self._total_bytes > self.max_bytes:
+                victim = db.execute("SELECT key, size FROM overpass_cache ORDER BY accessed LIMIT 1").fetchone()
+                if victim is None:
+                    break
+                db.execute("DELETE FROM overpass_cache WHERE key = ?", (victim[0],))
+                self._total_bytes -= victim[1]
+                self.evictions += 1
+            db.commit()
+    
+    def summary(self):
+        lookups = self.hits + self.misses
+        rate = (100.0 * self.hits / lookups) if lookups else 0.0
+        return (f"{self.hits} hits / {self.misses} misses ({rate:.0f}% hit rate), "
+                f"{self.expired} expired, {self.evictions} evicted, {self._total_bytes / 1e6:.1f}MB on disk")
+
+overpass_cache = OverpassCache(OVERPASS_CACHE_PATH, OVERPASS_CACHE_TTL_HOURS * 3600, OVERPASS_CACHE_MAX_MB * 1e6)
+
+AMENITY_FILTER = "restaurant|cafe|fast_food|food_court|toilets|hospital|clinic|pharmacy|hotel|fuel|atm|bank|parking"
+AMENITY_FILTER_PATTERN = re.compile(AMENITY_FILTER)  # same unanchored match Overpass applies with ~
+
+def _build_overpass_query(area):
+    """Build the amenity query for an Overpass area filter (around:... or a bbox)"""
+    return f"""
     [out:json][timeout:55];
     (
-        node["amenity"~"restaurant|cafe|fast_food|food_court|toilets|hospital|clinic|pharmacy|hotel|fuel|atm|bank|parking"](around:{radius_meters},{lat},{lng});
-        way["amenity"~"restaurant|cafe|fast_food|food_court|toilets|hospital|clinic|pharmacy|hotel|fuel|atm|bank|parking"](around:{radius_meters},{lat},{lng});
+        node["amenity"~"{AMENITY_FILTER}"]({area});
+        way["amenity"~"{AMENITY_FILTER}"]({area});
     );
     out center tags;
     """
-    
+
+def _backoff(reason, wait):
+    """Sleep before retrying an Overpass request, recording why"""
+    stats.incr(f'retries.{reason}')
+    with stats.timer('backoff_sleep'):
+        time.sleep(wait)
+
+def _failover(reason, mirror):
+    """Retry straight away on another mirror instead of sleeping"""
+    stats.incr(f'retries.{reason}')
+    stats.incr('failovers')
+    print(f"  🔀 {reason} from {mirror.split('/')[2]} - failing over to another mirror")
+
+def _post_overpass(query):
+    """
+    POST a query to Overpass with retry logic for 429 and 5xx errors
+    Each attempt goes to the fastest healthy mirror; on 429/502/503/504, timeouts and
+    connection errors the mirror cools down and the next attempt fails over immediately,
+    only backing off when no other mirror is healthy
+    A 200 whose remark reports an Overpass "runtime error" (query timeout, out of memory)
+    carries partial or no elements, so it is retried like a server error
+    Returns the decoded JSON payload, or None if the request failed for good
+    """
     attempt = 0
     while attempt < OVERPASS_MAX_RETRIES:
         attempt += 1
+        mirror = overpass_mirrors.choose()
+        rate_limiter.acquire()
         try:
-            response = requests.post(
-                OVERPASS_URL,
-                data=query,
-                headers={'Content-Type': 'text/plain'},
-                timeout=OVERPASS_TIMEOUT
-            )
+            stats.incr('requests')
+            started = time.monotonic()
+            with stats.timer('overpass_request'):
+                response = http_session.post(
+                    mirror,
+                    data=query.encode('utf-8'),
+                    timeout=OVERPASS_TIMEOUT
+                )
+            stats.incr(f'http.{response.status_code}')
+            stats.incr('bytesReceived', len(response.content))
             
             if response.status_code == 200:
-                data = response.json()
-                amenities_with_distance = []
-                
-                if 'elements' not in data or len(data['elements']) == 0:
-                    print(f"  ⚠️  No amenities found")
-                    return []
-                
-                for element in data['elements']:
-                    amenity_type = element.get('tags', {}).get('amenity')
-                    name = element.get('tags', {}).get('name', 'Unknown')
-                    
-                    # Get coordinates (for nodes or center of ways)
-                    if 'lat' in element and 'lon' in element:
-                        amenity_lat = element['lat']
-                        amenity_lng = element['lon']
-                    elif 'center' in element:
-                        amenity_lat = element['center']['lat']
-                        amenity_lng = element['center']['lon']
-                    else:
+                with stats.timer('json_parse'):
+                    data = response.json()
+                remark = data.get('remark') or ''
+                if 'runtime error' in remark:
+                    wait = BACKOFF_BASE ** attempt + random.uniform(0, 3)
+                    if overpass_mirrors.report_failure(mirror):
+                        _failover('runtime_error', mirror)
                         continue
-                    
-                    # Calculate distance
-                    distance = calculate_distance(lat, lng, amenity_lat, amenity_lng)
-                    
-                    # Categorize amenity
-                    category = categorize_amenity(amenity_type)
-                    
-                    if category and distance <= radius_meters:
-                        amenities_with_distance.append({
-                            'type': category,
-                            'amenity': amenity_type,
-                            'name': name,
-                            'distance': round(distance, 2),
-                            'lat': amenity_lat,
-                            'lng': amenity_lng
-                        })
-                
-                # Sort by distance
-                amenities_with_distance.sort(key=lambda x: x['distance'])
-                
-                print(f"  ✅ Found {len(amenities_with_distance)} amenities")
-                return amenities_with_distance
+                    print(f"  ⚠️  Overpass {remark.strip()[:80]} - retrying after {wait:.1f}s (attempt {attempt}/{OVERPASS_MAX_RETRIES})")
+                    _backoff('runtime_error', wait)
+                    continue
+                overpass_mirrors.report_success(mirror, time.monotonic() - started)
+                rate_limiter.on_success()
+                return data
                 
             elif response.status_code == 429:
                 # Rate limited - use exponential backoff with jitter
@@ -109,263 +482,1335 @@ def fetch_amenities_from_osm(lat, lng, radius_meters=2000):
                 else:
                     wait = BACKOFF_BASE ** attempt + random.uniform(0, 3)
                 
+                if overpass_mirrors.report_failure(mirror, cooldown=wait):
+                    _failover('429', mirror)
+                    continue
+                
                 print(f"  🚫 429 Rate limited - waiting {wait:.1f}s (attempt {attempt}/{OVERPASS_MAX_RETRIES})")
-                time.sleep(wait)
+                rate_limiter.on_overload(wait)
+                _backoff('429', wait)
                 continue
                 
             elif 500 <= response.status_code < 600:
                 # Server error - exponential backoff
                 wait = BACKOFF_BASE ** attempt + random.uniform(0, 3)
+                if response.status_code in (502, 503, 504) and overpass_mirrors.report_failure(mirror):
+                    _failover(str(response.status_code), mirror)
+                    continue
+                if response.status_code == 504:
+                    rate_limiter.on_overload()
                 print(f"  ⚠️  Server error {response.status_code} - retrying after {wait:.1f}s (attempt {attempt}/{OVERPASS_MAX_RETRIES})")
-                time.sleep(wait)
+                _backoff(str(response.status_code), wait)
                 continue
             else:
                 print(f"  ⚠️  API Error: {response.status_code}")
-                return []
+                return None
                 
         except requests.exceptions.Timeout:
+            if overpass_mirrors.report_failure(mirror):
+                _failover('timeout', mirror)
+                continue
             wait = BACKOFF_BASE ** attempt + random.uniform(0, 3)
             print(f"  ⏱️  Timeout - retrying after {wait:.1f}s (attempt {attempt}/{OVERPASS_MAX_RETRIES})")
-            time.sleep(wait)
+            _backoff('timeout', wait)
             continue
         except requests.exceptions.RequestException as e:
+            if overpass_mirrors.report_failure(mirror):
+                _failover('connection', mirror)
+                continue
             wait = BACKOFF_BASE ** attempt + random.uniform(0, 3)
             print(f"  🔌 Connection error: {str(e)} - retrying after {wait:.1f}s (attempt {attempt}/{OVERPASS_MAX_RETRIES})")
-            time.sleep(wait)
+            _backoff('connection', wait)
             continue
         except Exception as e:
             wait = BACKOFF_BASE ** attempt + random.uniform(0, 3)
             print(f"  ❌ Error: {str(e)} - retrying after {wait:.1f}s (attempt {attempt}/{OVERPASS_MAX_RETRIES})")
-            time.sleep(wait)
+            _backoff('error', wait)
             continue
     
     print(f"  ❌ Failed after {OVERPASS_MAX_RETRIES} attempts")
-    return []
+    stats.incr('requestsFailed')
+    return None
+
+def _parse_amenity_elements(elements):
+    """Flatten Overpass elements into (amenity_type, name, lat, lng) tuples"""
+    parsed = []
+    for element in elements:
+        tags = element.get('tags', {})
+        
+        # Get coordinates (for nodes or center of ways)
+        if 'lat' in element and 'lon' in element:
+            amenity_lat = element['lat']
+            amenity_lng = element['lon']
+        elif 'center' in element:
+            amenity_lat = element['center']['lat']
+            amenity_lng = element['center']['lon']
+        else:
+            continue
+        
+        parsed.append((tags.get('amenity'), tags.get('name', 'Unknown'), amenity_lat, amenity_lng))
+    return parsed
+
+def _fetch_elements(area):
+    """
+    Parsed amenity elements for an Overpass area, served from overpass_cache when possible
+    Returns None if the request failed for good (failures are never cached)
+    """
+    with stats.timer('cache'):
+        parsed = overpass_cache.get(area)
+    if parsed is not None:
+        print(f"  💾 Cache hit ({len(parsed)} elements)")
+        return parsed
+    
+    data = _post_overpass(_build_overpass_query(area))
+    if data is None:
+        return None
+    
+    with stats.timer('element_parse'):
+        parsed = _parse_amenity_elements(data.get('elements') or [])
+    with stats.timer('cache'):
+        overpass_cache.put(area, parsed)
+    return parsed
+
+def _element_arrays(parsed_elements):
+    """
+    Keep only elements with a known category and stack their coordinates into arrays
+    Returns (elements, categories, lats, lngs); build once and reuse for every station of a cluster
+    """
+    elements = []
+    categories = []
+    for element in parsed_elements:
+        category = categorize_amenity(element[0])
+        if category:
+            elements.append(element)
+            categories.append(category)
+    
+    coords = np.array([(e[2], e[3]) for e in elements], dtype=np.float64).reshape(-1, 2)
+    return elements, categories, coords[:, 0], coords[:, 1]
+
+def _amenities_near(lat, lng, parsed_elements, radius_meters, arrays=None):
+    """Build the amenitiesDetail list for one point from parsed elements, sorted by distance"""
+    with stats.timer('distance_math'):
+        return _amenities_near_arrays(lat, lng, arrays or _element_arrays(parsed_elements), radius_meters)
+
+def _amenities_near_arrays(lat, lng, arrays, radius_meters):
+    elements, categories, lats, lngs = arrays
+    if not elements:
+        return []
+    
+    # Distance, radius filter and sort for all elements in one pass
+    distances = calculate_distances(lat, lng, lats, lngs)
+    within = np.flatnonzero(distances <= radius_meters)
+    within = within[np.argsort(np.round(distances[within], 2), kind='stable')]
+    
+    amenities_with_distance = []
+    for i in within.tolist():
+        amenity_type, name, amenity_lat, amenity_lng = elements[i]
+        amenities_with_distance.append({
+            'type': categories[i],
+            'amenity': amenity_type,
+            'name': name,
+            'distance': round(float(distances[i]), 2),
+            'lat': amenity_lat,
+            'lng': amenity_lng
+        })
+    return amenities_with_distance
+
+def fetch_amenities_from_osm(lat, lng, radius_meters=2000):
+    """
+    Fetch ALL amenities near a location using OpenStreetMap Overpass API
+    with retry logic for 429 and 504 errors
+    Returns a list of ALL amenities with their types and distances,
+    or None if Overpass could not be reached (so callers can tell it apart from no amenities)
+    """
+    print(f"  Fetching amenities for ({lat}, {lng})...")
+    
+    # Query coordinates are rounded so nearby reruns share cache entries;
+    # distances below still use the exact station position
+    p = OVERPASS_CACHE_PRECISION
+    parsed = _fetch_elements(f"around:{radius_meters},{round(lat, p)},{round(lng, p)}")
+    if parsed is None:
+        return None
+    
+    if len(parsed) == 0:
+        print(f"  ⚠️  No amenities found")
+        return []
+    
+    amenities_with_distance = _amenities_near(lat, lng, parsed, radius_meters)
+    
+    print(f"  ✅ Found {len(amenities_with_distance)} amenities")
+    return amenities_with_distance
+
+def cluster_stations(points, cell_meters=None):
+    """
+    Group (lat, lng) points into square grid tiles of roughly cell_meters per side
+    Returns a list of index lists, one per non-empty tile
+    """
+    cell_meters = cell_meters or CLUSTER_CELL_METERS
+    lat_step = cell_meters / METERS_PER_DEGREE
+    
+    tiles = {}
+    for idx, (lat, lng) in enumerate(points):
+        row = math.floor(lat / lat_step)
+        # Longitude step shrinks with latitude; use the tile row's center so a row shares one step
+        row_center = (row + 0.5) * lat_step
+        lng_step = cell_meters / (METERS_PER_DEGREE * max(math.cos(math.radians(row_center)), 0.01))
+        col = math.floor(lng / lng_step)
+        tiles.setdefault((row, col), []).append(idx)
+    
+    return list(tiles.values())
+
+def fetch_amenities_for_cluster(points, radius_meters=2000):
+    """
+    Fetch amenities for several nearby (lat, lng) points with ONE Overpass bbox query
+    Each point gets its own list, filtered locally by calculate_distance
+    Returns a list of amenity lists aligned with points; every entry is None if the fetch failed
+    """
+    if len(points) == 1:
+        lat, lng = points[0]
+        return [fetch_amenities_from_osm(lat, lng, radius_meters)]
+    
+    # Pad the bounding box by the search radius so edge stations see their full circle
+    lats = [p[0] for p in points]
+    lngs = [p[1] for p in points]
+    lat_pad = radius_meters / METERS_PER_DEGREE
+    lng_pad = radius_meters / (METERS_PER_DEGREE * max(math.cos(math.radians(max(abs(l) for l in lats))), 0.01))
+    south, north = min(lats) - lat_pad, max(lats) + lat_pad
+    west, east = min(lngs) - lng_pad, max(lngs) + lng_pad
+    
+    print(f"  Fetching amenities for cluster of {len(points)} stations ({south:.4f},{west:.4f},{north:.4f},{east:.4f})...")
+    
+    p = OVERPASS_CACHE_PRECISION
+    parsed = _fetch_elements(f"{south:.{p}f},{west:.{p}f},{north:.{p}f},{east:.{p}f}")
+    if parsed is None:
+        return [None for _ in points]
+    if not parsed:
+        print(f"  ⚠️  No amenities found for cluster")
+        return [[] for _ in points]
+    
+    arrays = _element_arrays(parsed)
+    results = [_amenities_near(lat, lng, parsed, radius_meters, arrays) for lat, lng in points]
+    
+    print(f"  ✅ Found {len(parsed)} amenities in cluster bbox")
+    return results
+
+# OSM amenity tag -> broader category stored on stations
+AMENITY_CATEGORIES = {
+    'restaurant': 'food',
+    'cafe': 'food',
+    'fast_food': 'food',
+    'food_court': 'food',
+    'toilets': 'washroom',
+    'hospital': 'medical',
+    'clinic': 'medical',
+    'pharmacy': 'medical',
+    'hotel': 'hotel',
+    'motel': 'hotel',
+    'guest_house': 'hotel',
+    'fuel': 'fuel',
+    'atm': 'atm',
+    'bank': 'atm',
+    'parking': 'parking'
+}
+
+EARTH_RADIUS_METERS = 6371000
 
 def categorize_amenity(amenity_type):
     """Categorize amenity into broader types"""
     if not amenity_type:
         return None
     
-    mapping = {
-        'restaurant': 'food',
-        'cafe': 'food',
-        'fast_food': 'food',
-        'food_court': 'food',
-        'toilets': 'washroom',
-        'hospital': 'medical',
-        'clinic': 'medical',
-        'pharmacy': 'medical',
-        'hotel': 'hotel',
-        'motel': 'hotel',
-        'guest_house': 'hotel',
-        'fuel': 'fuel',
-        'atm': 'atm',
-        'bank': 'atm',
-        'parking': 'parking'
-    }
-    
-    return mapping.get(amenity_type.lower())
+    return AMENITY_CATEGORIES.get(amenity_type.lower())
 
 def calculate_distance(lat1, lon1, lat2, lon2):
     """Calculate distance in meters using Haversine formula"""
-    from math import radians, sin, cos, sqrt, atan2
+    lat1_rad = math.radians(lat1)
+    lat2_rad = math.radians(lat2)
+    delta_lat = math.radians(lat2 - lat1)
+    delta_lon = math.radians(lon2 - lon1)
     
-    R = 6371000  # Earth's radius in meters
+    a = math.sin(delta_lat/2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(delta_lon/2)**2
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
     
-    lat1_rad = radians(lat1)
-    lat2_rad = radians(lat2)
-    delta_lat = radians(lat2 - lat1)
-    delta_lon = radians(lon2 - lon1)
+    return EARTH_RADIUS_METERS * c
+
+def calculate_distances(lat, lng, lats, lngs):
+    """Vectorized calculate_distance: meters from one point to arrays of points"""
+    lats_rad = np.radians(np.asarray(lats, dtype=np.float64))
+    lngs_rad = np.radians(np.asarray(lngs, dtype=np.float64))
+    lat_rad = math.radians(lat)
+    
+    delta_lat = lats_rad - lat_rad
+    delta_lon = lngs_rad - math.radians(lng)
     
-    a = sin(delta_lat/2)**2 + cos(lat1_rad) * cos(lat2_rad) * sin(delta_lon/2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1-a))
+    a = np.sin(delta_lat / 2) ** 2 + math.cos(lat_rad) * np.cos(lats_rad) * np.sin(delta_lon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
     
-    return R * c
+    return EARTH_RADIUS_METERS * c
 
-def update_stations_with_empty_amenities():
+class OfflineAmenityIndex:
+    """
+    Amenities from a local OSM extract bucketed into a uniform lat/lng grid
+    Answers the same radius query as fetch_amenities_from_osm in memory,
+    returning the same amenitiesDetail entries
+    """
+    
+    def __init__(self, parsed_elements, cell_meters=2000):
+        # Keep the same tag set the Overpass query asks for
+        parsed_elements = [e for e in parsed_elements if e[0] and AMENITY_FILTER_PATTERN.search(e[0])]
+        elements, categories, lats, lngs = _element_arrays(parsed_elements)
+        
+        self.cell_meters = cell_meters
+        self.lat_step = cell_meters / METERS_PER_DEGREE
+        # Size longitude cells for the highest latitude so every cell is at least cell_meters wide
+        max_abs_lat = min(float(np.abs(lats).max()) + self.lat_step, 89.0) if len(lats) else 0.0
+        self.lng_step = cell_meters / (METERS_PER_DEGREE * max(math.cos(math.radians(max_abs_lat)), 0.01))
+        
+        rows = np.floor(lats / self.lat_step).astype(np.int64)
+        cols = np.floor(lngs / self.lng_step).astype(np.int64)
+        order = np.lexsort((cols, rows))
+        
+        self.elements = [elements[i] for i in order.tolist()]
+        self.categories = [categories[i] for i in order.tolist()]
+        self.lats = lats[order]
+        self.lngs = lngs[order]
+        
+        # (row, col) -> slice of the sorted arrays
+        self.cells = {}
+        rows, cols = rows[order], cols[order]
+        if len(order):
+            breaks = np.flatnonzero((np.diff(rows) != 0) | (np.diff(cols) != 0)) + 1
+            starts = np.concatenate(([0], breaks))
+            ends = np.concatenate((breaks, [len(order)]))
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                self.cells[(int(rows[start]), int(cols[start]))] = (start, end)
+    
+    def __len__(self):
+        return len(self.elements)
+    
+    def query(self, lat, lng, radius_meters=2000):
+        """amenitiesDetail for a point, sorted by distance"""
+        span = max(1, math.ceil(radius_meters / self.cell_meters))
+        row = math.floor(lat / self.lat_step)
+        col = math.floor(lng / self.lng_step)
+        
+        slices = []
+        for r in range(row - span, row + span + 1):
+            for c in range(col - span, col + span + 1):
+                cell = self.cells.get((r, c))
+                if cell:
+                    slices.append(np.arange(*cell))
+        if not slices:
+            return []
+        
+        idx = np.concatenate(slices)
+        subset = [self.elements[i] for i in idx.tolist()]
+        categories = [self.categories[i] for i in idx.tolist()]
+        return _amenities_near(lat, lng, subset, radius_meters, (subset, categories, self.lats[idx], self.lngs[idx]))
+    
+    @classmethod
+    def from_file(cls, path):
+        """
+        Load amenities from a local extract:
+        .geojson (e.g. `osmium export`), Overpass JSON (.json with "elements"),
+        .csv with amenity,name,lat,lon columns, or .pbf (needs the osmium package)
+        """
+        lower = path.lower()
+        if lower.endswith('.pbf'):
+            return cls(_load_pbf_amenities(path))
+        if lower.endswith('.csv'):
+            return cls(_load_csv_amenities(path))
+        
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if 'elements' in data:
+            return cls(_parse_amenity_elements(data['elements']))
+        if 'features' in data:
+            return cls(_load_geojson_amenities(data))
+        raise ValueError(f"Unrecognized OSM extract format: {path}")
+
+def _geometry_center(geometry):
+    """Point coordinates, or the mean vertex of a line/polygon geometry, as (lat, lng)"""
+    coords = geometry.get('coordinates')
+    if geometry.get('type') == 'Point':
+        return coords[1], coords[0]
+    flat = np.asarray(_flatten_positions(coords), dtype=np.float64)
+    if not len(flat):
+        return None
+    return float(flat[:, 1].mean()), float(flat[:, 0].mean())
+
+def _flatten_positions(coords):
+    if coords and isinstance(coords[0], (int, float)):
+        return [coords[:2]]
+    positions = []
+    for c in coords or []:
+        positions.extend(_flatten_positions(c))
+    return positions
+
+def _load_geojson_amenities(data):
+    parsed = []
+    for feature in data.get('features', []):
+        props = feature.get('properties') or {}
+        # osmium export keeps tags as properties; some exporters nest them under "tags"
+        tags = props.get('tags') if isinstance(props.get('tags'), dict) else props
+        geometry = feature.get('geometry') or {}
+        if not tags.get('amenity') or not geometry.get('coordinates'):
+            continue
+        center = _geometry_center(geometry)
+        if center:
+            parsed.append((tags['amenity'], tags.get('name', 'Unknown'), center[0], center[1]))
+    return parsed
+
+def _load_csv_amenities(path):
+    parsed = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            try:
+                lat = float(row['lat'])
+                lng = float(row.get('lon') or row.get('lng'))
+            except (KeyError, TypeError, ValueError):
+                continue
+            parsed.append((row.get('amenity'), row.get('name') or 'Unknown', lat, lng))
+    return parsed
+
+def _load_pbf_amenities(path):
+    try:
+        import osmium
+    except ImportError:
+        raise RuntimeError("Reading .pbf extracts needs the osmium package (pip install osmium), "
+                           "or export to GeoJSON first: osmium tags-filter ... | osmium export -o amenities.geojson")
+    
+    parsed = []
+    
+    class AmenityHandler(osmium.SimpleHandler):
+        def node(self, n):
+            amenity = n.tags.get('amenity')
+            if amenity and AMENITY_FILTER_PATTERN.search(amenity):
+                parsed.append((amenity, n.tags.get('name', 'Unknown'), n.location.lat, n.location.lon))
+        
+        def way(self, w):
+            amenity = w.tags.get('amenity')
+            if amenity and AMENITY_FILTER_PATTERN.search(amenity):
+                locations = [(nd.lat, nd.lon) for nd in w.nodes if nd.location.valid()]
+                if locations:
+                    lat = sum(l[0] for l in locations) / len(locations)
+                    lng = sum(l[1] for l in locations) / len(locations)
+                    parsed.append((amenity, w.tags.get('name', 'Unknown'), lat, lng))
+    
+    AmenityHandler().apply_file(path, locations=True)
+    return parsed
+
+# Set by --osm-extract; when present amenities come from this index instead of Overpass
+offline_index = None
+
+class BulkWriter:
+    """
+    Buffers inserts/updates and sends them with one unordered bulk_write
+    Flushes when batch_size ops are queued or the oldest queued op is flush_seconds old;
+    a failed batch is reported and counted but never aborts the run
+    """
+    
+    def __init__(self, target, batch_size=None, flush_seconds=None, on_flush=None):
+        self.target = target
+        self.batch_size = max(1, batch_size or MONGO_BATCH_SIZE)
+        self.flush_seconds = MONGO_FLUSH_SECONDS if flush_seconds is None else flush_seconds
+        # Called with the refs of the flushed ops whose writes succeeded
+        self.on_flush = on_flush
+        self.ops = []
+        self.labels = []
+        self.refs = []
+        self.oldest = None
+        self.batches = 0
+        self.inserted = 0
+        self.upserted = 0
+        self.updated = 0
+        self.failed = 0
+    
+    def insert(self, doc, label=None, ref=None):
+        self._add(InsertOne(doc), label or doc.get('name'), ref)
+    
+    def update(self, filter_doc, update_doc, label=None, upsert=False, ref=None):
+        self._add(UpdateOne(filter_doc, update_doc, upsert=upsert), label, ref)
+    
+    def _add(self, op, label, ref):
+        if not self.ops:
+            self.oldest = time.monotonic()
+        self.ops.append(op)
+        self.labels.append(label)
+        self.refs.append(ref)
+        if len(self.ops) >= self.batch_size or time.monotonic() - self.oldest >= self.flush_seconds:
+            self.flush()
+    
+    def flush(self):
+        if not self.ops:
+            return
+        ops, labels, refs = self.ops, self.labels, self.refs
+        self.ops, self.labels, self.refs = [], [], []
+        self.batches += 1
+        
+        stats.incr('dbBatches')
+        stats.incr('dbOps', len(ops))
+        try:
+            with stats.timer('db_write'):
+                result = self.target.bulk_write(ops, ordered=False)
+            self.inserted += result.inserted_count
+            self.upserted += result.upserted_count
+            self.updated += result.matched_count
+        except BulkWriteError as e:
+            details = e.details
+            errors = details.get('writeErrors', [])
+            self.inserted += details.get('nInserted', 0)
+            self.upserted += details.get('nUpserted', 0)
+            self.updated += details.get('nMatched', 0)
+            self.failed += len(errors)
+            failed_indexes = {err['index'] for err in errors}
+            written = [ref for i, ref in enumerate(refs) if i not in failed_indexes]
+            print(f"  ❌ Batch {self.batches}: {len(errors)} of {len(ops)} writes failed")
+            for err in errors[:5]:
+                print(f"     - {labels[err['index']] or err['index']}: [{err.get('code')}] {err.get('errmsg')}")
+            if len(errors) > 5:
+                print(f"     ... and {len(errors) - 5} more")
+        except PyMongoError as e:
+            self.failed += len(ops)
+            written = []
+            print(f"  ❌ Batch {self.batches}: all {len(ops)} writes failed: {str(e)}")
+        else:
+            written = refs
+            print(f"  💾 Batch {self.batches}: wrote {len(ops)} documents")
+        
+        if self.on_flush:
+            self.on_flush(written)
+    
+    close = flush
+
+class StationNameIndex:
+    """
+    In-memory index of existing stations for O(1) duplicate checks during import
+    Keys are the case-insensitive name, plus coordinates rounded to coord_precision
+    decimals when by_coords is set (so same-named chain stations in different places
+    are kept). Loaded once from the collection; stations queued this run are added as they go
+    """
+    
+    def __init__(self, by_coords=None, coord_precision=None):
+        self.by_coords = DEDUP_BY_COORDS if by_coords is None else by_coords
+        self.coord_precision = DEDUP_COORD_PRECISION if coord_precision is None else coord_precision
+        self.ids = {}
+    
+    def key(self, name, latitude=None, longitude=None):
+        name_key = (name or '').strip().lower()
+        if not self.by_coords:
+            return name_key
+        if latitude is None or longitude is None:
+            return (name_key, None, None)
+        return (name_key, round(float(latitude), self.coord_precision), round(float(longitude), self.coord_precision))
+    
+    def load(self, target):
+        """Preload every station name (and coordinates) with a single projected scan"""
+        projection = {'name': 1, 'latitude': 1, 'longitude': 1}
+        for doc in target.find({}, projection):
+            self.ids[self.key(doc.get('name'), doc.get('latitude'), doc.get('longitude'))] = doc.get('_id')
+        return self
+    
+    def find(self, name, latitude=None, longitude=None):
+        """Return (True, existing _id or None if queued this run) for a duplicate, else (False, None)"""
+        key = self.key(name, latitude, longitude)
+        if key in self.ids:
+            return True, self.ids[key]
+        return False, None
+    
+    def add(self, name, latitude=None, longitude=None, station_id=None):
+        self.ids[self.key(name, latitude, longitude)] = station_id
+    
+    def __len__(self):
+        return len(self.ids)
+
+class ImportCheckpoint:
+    """
+    Tracks the CSV position below which every row is committed (skipped, failed to
+    fetch or successfully written to MongoDB) and persists it to a JSON file so a
+    restarted import can seek straight past it. Rows still in flight, or whose write
+    failed, are re-read on resume; upserts on stationKey make replaying them harmless
+    """
+    
+    def __init__(self, path, csv_path, every_seconds=None):
+        self.path = path
+        self.csv_path = os.path.abspath(csv_path)
+        self.csv_size = os.path.getsize(csv_path)
+        self.every_seconds = CHECKPOINT_SECONDS if every_seconds is None else every_seconds
+        self.pending = OrderedDict()  # row -> byte offset where the row starts
+        self.last_row = 0
+        self.last_offset = None
+        self.saved_at = time.monotonic()
+    
+    def load(self):
+        """Return the saved {'row', 'offset'} position for this CSV, or None"""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️  Ignoring unreadable checkpoint {self.path}: {str(e)}")
+            return None
+        if state.get('csvPath') != self.csv_path or state.get('csvSize') != self.csv_size:
+            print(f"⚠️  Ignoring checkpoint {self.path} - it was written for a different CSV")
+            return None
+        return state
+    
+    def read(self, row, start_offset, end_offset, in_flight):
+        """Record a row read from the CSV; in_flight rows stay uncommitted until released"""
+        if in_flight:
+            self.pending[row] = start_offset
+        self.last_row, self.last_offset = row, end_offset
+    
+    def release(self, rows):
+        for row in rows:
+            self.pending.pop(row, None)
+    
+    def position(self):
+        """(last committed row, offset to resume reading from)"""
+        if self.pending:
+            row, offset = next(iter(self.pending.items()))
+            return row - 1, offset
+        return self.last_row, self.last_offset
+    
+    def save(self, counts, force=False):
+        if self.last_offset is None or (not force and time.monotonic() - self.saved_at < self.every_seconds):
+            return
+        row, offset = self.position()
+        state = {
+            'csvPath': self.csv_path,
+            'csvSize': self.csv_size,
+            'row': row,
+            'offset': offset,
+            'inFlightRows': list(self.pending.keys()),
+            'counts': counts,
+            'savedAt': datetime.utcnow().isoformat()
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+        self.saved_at = time.monotonic()
+    
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def station_key(name, latitude, longitude):
+    """Stable identity of a CSV station: case-insensitive name plus rounded coordinates"""
+    p = STATION_KEY_PRECISION
+    raw = f"{name.strip().lower()}|{round(float(latitude), p)}|{round(float(longitude), p)}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+def group_work_units(stations, cluster=False):
+    """
+    Yield lists of stations that are fetched together
+    One station per unit normally; with cluster=True stations are buffered in
+    batches of CLUSTER_BATCH_SIZE and each grid tile becomes one unit
+    """
+    if not cluster:
+        for station in stations:
+            yield [station]
+        return
+    
+    def clusters_of(batch):
+        if batch:
+            groups = cluster_stations([(s['latitude'], s['longitude']) for s in batch])
+            print(f"\n🧩 Grouped {len(batch)} stations into {len(groups)} clusters")
+            for members in groups:
+                yield [batch[i] for i in members]
+    
+    batch = []
+    for station in stations:
+        batch.append(station)
+        if len(batch) >= CLUSTER_BATCH_SIZE:
+            yield from clusters_of(batch)
+            batch = []
+    yield from clusters_of(batch)
+
+def fetch_work_unit(unit):
+    """Fetch amenities for a work unit; returns one amenity list per station (None where the fetch failed)"""
+    if len(unit) == 1:
+        print(f"\nProcessing: {unit[0].get('name', 'Unknown')}, {unit[0].get('city', 'Unknown')}")
+    else:
+        print(f"\nProcessing cluster of {len(unit)} stations around {unit[0].get('city', 'Unknown')}")
+    if offline_index is not None:
+        return [offline_index.query(s['latitude'], s['longitude'], 2000) for s in unit]
+    return fetch_amenities_for_cluster([(s['latitude'], s['longitude']) for s in unit], 2000)
+
+def run_amenity_fetches(units, fetch=fetch_work_unit, workers=1):
+    """
+    Run fetch(unit) over units, yielding (unit, result, error) as each finishes
+    workers <= 1 keeps the sequential flow with IMPORT_SLEEP_SECONDS between requests
+    (skipped after units answered entirely from overpass_cache); otherwise up to `workers` requests are in flight and pacing is left to rate_limiter
+    units is consumed lazily, so a CSV is never read ahead by more than `workers` units
+    """
+    if workers <= 1:
+        for unit in units:
+            requests_before = stats.counters.get('requests', 0)
+            try:
+                yield unit, fetch(unit), None
+            except Exception as e:
+                yield unit, None, e
+                continue
+            # Rate limiting - wait between requests to avoid 429 (nothing to wait for offline
+            # or when the unit never reached Overpass)
+            if offline_index is None and stats.counters.get('requests', 0) != requests_before:
+                with stats.timer('pacing_sleep'):
+                    time.sleep(IMPORT_SLEEP_SECONDS)
+        return
+    
+    def finished(future):
+        unit = in_flight.pop(future)
+        error = future.exception()
+        return unit, (None if error else future.result()), error
+    
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = {}
+        for unit in units:
+            in_flight[pool.submit(fetch, unit)] = unit
+            if len(in_flight) >= workers:
+                done, _ = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    yield finished(future)
+        for future in futures.as_completed(list(in_flight)):
+            yield finished(future)
+
+def summarize_amenities(all_amenities, top_k=None):
+    """
+    Compact per-category view of a station's amenities
+    {category: {'count', 'nearest' (meters), 'top': the top_k nearest entries}}
+    """
+    top_k = AMENITY_TOP_K if top_k is None else top_k
+    summary = {}
+    for amenity in sorted(all_amenities, key=lambda a: a['distance']):
+        entry = summary.setdefault(amenity['type'], {'count': 0, 'nearest': amenity['distance'], 'top': []})
+        entry['count'] += 1
+        if len(entry['top']) < top_k:
+            entry['top'].append({k: v for k, v in amenity.items() if k != 'type'})
+    return summary
+
+def amenity_fields(all_amenities):
+    """Station document fields for fetched amenities, following AMENITY_DETAIL_MODE"""
+    fields = {
+        # Unique category names for quick filtering
+        'amenities': list(set([a['type'] for a in all_amenities])),
+        'amenitiesSummary': summarize_amenities(all_amenities)
+    }
+    if AMENITY_DETAIL_MODE == 'inline':
+        fields['amenitiesDetail'] = all_amenities  # Store ALL amenities
+    return fields
+
+def _amenity_update(fields):
+    """$set the given fields, clearing an inline amenitiesDetail left by an older run if it no longer belongs there"""
+    update = {'$set': fields}
+    if AMENITY_DETAIL_MODE != 'inline':
+        update['$unset'] = {'amenitiesDetail': ''}
+    return update
+
+def _detail_writer():
+    """BulkWriter for the stationamenities collection, or None unless AMENITY_DETAIL_MODE=separate"""
+    return BulkWriter(amenity_details) if AMENITY_DETAIL_MODE == 'separate' else None
+
+def _save_amenity_detail(detail_writer, key, all_amenities, label=None):
+    """Queue the full amenity list for a station (by stationKey) into stationamenities"""
+    if detail_writer is None:
+        return
+    detail_writer.update(
+        {'_id': key},
+        {'$set': {'amenitiesDetail': all_amenities, 'updatedAt': datetime.utcnow()}},
+        label=label,
+        upsert=True
+    )
+
+def _save_amenities(writer, station, all_amenities, label=None, detail_writer=None):
+    """Queue a write of fetched amenities onto an existing station document"""
+    fields = amenity_fields(all_amenities)
+    if valid_coordinates(station['latitude'], station['longitude']):
+        fields['location'] = location_point(station['latitude'], station['longitude'])
+    fields['updatedAt'] = datetime.utcnow()
+    
+    writer.update({'_id': station['_id']}, _amenity_update(fields), label=label)
+    _save_amenity_detail(detail_writer, station_key(station['name'], station['latitude'], station['longitude']),
+                         all_amenities, label=label)
+    return fields['amenities']
+
+def parse_shard(spec):
+    """Parse "i/N" (1 <= i <= N) into (i, N)"""
+    try:
+        index, total = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{spec}' - expected i/N, e.g. 2/4")
+    if total < 1 or not 1 <= index <= total:
+        raise ValueError(f"Invalid shard '{spec}' - need 1 <= i <= N")
+    return index, total
+
+def _shard_range(shard):
+    """
+    _id bounds of shard i/N over the whole collection, ordered by _id
+    Computed on all stations (not just the ones left to update) so every worker
+    gets the same boundaries no matter when it starts
+    """
+    index, total = shard
+    count = collection.estimated_document_count()
+    
+    def boundary(k):
+        if k <= 0 or k >= total:
+            return None
+        doc = next(iter(collection.find({}, {'_id': 1}).sort('_id', 1).skip(count * k // total).limit(1)), None)
+        return doc['_id'] if doc else None
+    
+    bounds = {}
+    lower, upper = boundary(index - 1), boundary(index)
+    if lower is not None:
+        bounds['$gte'] = lower
+    if upper is not None:
+        bounds['$lt'] = upper
+    return bounds
+
+def _in_hash_shard(station_id, shard):
+    index, total = shard
+    return zlib.crc32(str(station_id).encode('utf-8')) % total == index - 1
+
+def valid_coordinates(latitude, longitude):
+    """
+    Whether a station position can be stored as a GeoJSON point
+    MongoDB rejects any write whose 2dsphere-indexed point is out of range (e.g. swapped lat/lng)
+    """
+    return (isinstance(latitude, (int, float)) and isinstance(longitude, (int, float))
+            and -90 <= latitude <= 90 and -180 <= longitude <= 180)
+
+def location_point(latitude, longitude):
+    """GeoJSON point for a station; note the [lng, lat] order"""
+    return {'type': 'Point', 'coordinates': [longitude, latitude]}
+
+def ensure_location_index():
+    """Create the 2dsphere index on location (a no-op when it already exists)"""
+    try:
+        collection.create_index([('location', '2dsphere')])
+        return True
+    except PyMongoError as e:
+        # Typically existing documents with a malformed location
+        print(f"⚠️  Could not create 2dsphere index on location: {str(e)} - run --backfill-location")
+        return False
+
+def backfill_locations(batch_size=None):
+    """
+    One-shot migration writing a GeoJSON location for stations that lack one
+    (or only have the [0, 0] model default), then ensuring the 2dsphere index
+    Stations are paged by _id in batches, so an interrupted run can simply be rerun
+    """
+    batch_size = batch_size or LOCATION_BACKFILL_BATCH
+    stats.reset()
+    print("🚀 Backfilling GeoJSON location for existing stations...")
+    
+    query = {
+        'latitude': {'$ne': None},
+        'longitude': {'$ne': None},
+        '$or': [
+            {'location': {'$exists': False}},
+            {'location': None},
+            {'location.coordinates': [0, 0]}
+        ]
+    }
+    total_stations = collection.count_documents(query)
+    print(f"📊 Found {total_stations} stations without a location\n")
+    
+    updated_count = 0
+    skipped_count = 0
+    writer = BulkWriter(collection, batch_size=batch_size)
+    last_id = None
+    
+    while True:
+        page = dict(query, _id={'$gt': last_id}) if last_id is not None else query
+        batch = list(collection.find(page, {'_id': 1, 'latitude': 1, 'longitude': 1}).sort('_id', 1).limit(batch_size))
+        if not batch:
+            break
+        last_id = batch[-1]['_id']
+        
+        for station in batch:
+            latitude, longitude = station.get('latitude'), station.get('longitude')
+            if not valid_coordinates(latitude, longitude) or not (latitude or longitude):
+                skipped_count += 1
+                continue
+            writer.update({'_id': station['_id']}, {'$set': {'location': location_point(latitude, longitude)}})
+            updated_count += 1
+        
+        writer.flush()
+        stats.incr('stations', len(batch))
+        print(f"  ✅ Backfilled {updated_count}/{total_stations} stations")
+    
+    writer.close()
+    updated_count -= writer.failed
+    indexed = ensure_location_index()
+    
+    print(f"\n{'='*60}")
+    print(f"✅ Backfill Complete!")
+    print(f"📍 Locations written: {updated_count}")
+    print(f"⏭️  Skipped (no usable coordinates): {skipped_count}")
+    print(f"❌ Failed: {writer.failed}")
+    print(f"🗺️  2dsphere index on location: {'ready' if indexed else 'NOT created'}")
+    print(f"{'='*60}")
+    return {'mode': 'backfill-location', 'updated': updated_count, 'skipped': skipped_count,
+            'failed': writer.failed, 'indexed': indexed}
+
+def update_stations_with_empty_amenities(cluster=False, workers=None, shard=None, shard_mode='hash'):
     """
     Find all stations in DB with empty amenities array and fetch ALL amenities for them
+    Stations are streamed from a cursor projecting only the fields used here
+    With cluster=True, nearby stations share one Overpass bbox query per grid tile
+    With workers > 1, requests run concurrently under the shared token bucket
+    shard=(i, N) restricts this run to the i-th of N disjoint slices, by _id hash
+    or by _id range (shard_mode='range'), so several processes can split the backlog
     """
+    workers = workers or OVERPASS_WORKERS
+    stats.reset()
     print("🚀 Starting amenities update for stations with empty amenities...")
     
     # Find all stations with empty amenities array
-    stations_to_update = list(collection.find({
+    query = {
         '$or': [
             {'amenities': {'$exists': False}},
             {'amenities': []},
             {'amenities': None}
         ]
-    }))
+    }
+    if shard and shard_mode == 'range':
+        bounds = _shard_range(shard)
+        if bounds:
+            query = {'$and': [query, {'_id': bounds}]}
     
-    total_stations = len(stations_to_update)
-    print(f"📊 Found {total_stations} stations with empty amenities\n")
+    total_stations = collection.count_documents(query)
+    if shard:
+        print(f"🔀 Shard {shard[0]}/{shard[1]} by _id {shard_mode}")
+    if shard and shard_mode == 'hash':
+        # The hash filter runs client-side, so this is an estimate
+        total_stations = -(-total_stations // shard[1])
+        print(f"📊 Found ~{total_stations} stations with empty amenities in this shard\n")
+    else:
+        print(f"📊 Found {total_stations} stations with empty amenities\n")
     
     if total_stations == 0:
         print("✅ All stations already have amenities!")
-        return
+        return {'mode': 'update-empty', 'updated': 0, 'failed': 0}
     
+    ensure_location_index()
     updated_count = 0
     failed_count = 0
+    writer = BulkWriter(collection)
+    detail_writer = _detail_writer()
     
-    for idx, station in enumerate(stations_to_update, 1):
-        try:
+    projection = {'_id': 1, 'name': 1, 'city': 1, 'latitude': 1, 'longitude': 1}
+    
+    def located_stations():
+        nonlocal failed_count
+        with collection.find(query, projection, no_cursor_timeout=True).sort('_id', 1) as cursor:
+            for station in cursor:
+                if shard and shard_mode == 'hash' and not _in_hash_shard(station['_id'], shard):
+                    continue
+                if not station.get('latitude') or not station.get('longitude'):
+                    print(f"⚠️  Skipping {station.get('name', 'Unknown')} - No coordinates")
+                    failed_count += 1
+                    continue
+                yield station
+    
+    units = group_work_units(located_stations(), cluster=cluster)
+    for unit, results, error in run_amenity_fetches(units, workers=workers):
+        if error:
+            for station in unit:
+                print(f"  ❌ Error updating {station.get('name', 'Unknown')}: {str(error)}")
+            failed_count += len(unit)
+            continue
+        
+        stats.incr('stations', len(unit))
+        stats.progress()
+        for station, all_amenities in zip(unit, results):
             name = station.get('name', 'Unknown')
-            city = station.get('city', 'Unknown')
-            latitude = station.get('latitude')
-            longitude = station.get('longitude')
-            
-            if not latitude or not longitude:
-                print(f"⚠️  [{idx}/{total_stations}] Skipping {name} - No coordinates")
+            if all_amenities is None:
+                # Leave the station untouched so the next run retries it
+                print(f"  ❌ Error updating {name}: Overpass request failed")
                 failed_count += 1
                 continue
-            
-            print(f"\n[{idx}/{total_stations}] Processing: {name}, {city}")
-            
-            # Fetch ALL amenities from OSM
-            all_amenities = fetch_amenities_from_osm(latitude, longitude, 2000)
-            
-            if not all_amenities:
-                print(f"  ⚠️  No amenities found for {name}")
-                # Still update to avoid reprocessing
-                collection.update_one(
-                    {'_id': station['_id']},
-                    {
-                        '$set': {
-                            'amenities': [],
-                            'amenitiesDetail': [],
-                            'updatedAt': datetime.utcnow()
-                        }
-                    }
-                )
+            try:
+                if not all_amenities:
+                    print(f"  ⚠️  No amenities found for {name}")
+                
+                # Update the station in DB with ALL amenities (empty still updates to avoid reprocessing)
+                amenity_categories = _save_amenities(writer, station, all_amenities, label=name,
+                                                     detail_writer=detail_writer)
+                
                 updated_count += 1
-                time.sleep(IMPORT_SLEEP_SECONDS)
-                continue
-            
-            # Extract unique category names for quick filtering
-            amenity_categories = list(set([a['type'] for a in all_amenities]))
-            
-            # Update the station in DB with ALL amenities
-            collection.update_one(
-                {'_id': station['_id']},
-                {
-                    '$set': {
-                        'amenities': amenity_categories,
-                        'amenitiesDetail': all_amenities,  # Store ALL amenities
-                        'updatedAt': datetime.utcnow()
-                    }
-                }
-            )
-            
-            updated_count += 1
-            print(f"  ✅ Updated with {len(all_amenities)} total amenities ({len(amenity_categories)} types)")
-            
-            # Rate limiting - wait between requests to avoid 429
-            time.sleep(IMPORT_SLEEP_SECONDS)
-            
-        except Exception as e:
-            print(f"  ❌ Error updating {station.get('name', 'Unknown')}: {str(e)}")
-            failed_count += 1
-            continue
+                if all_amenities:
+                    print(f"  ✅ [{updated_count}/{total_stations}] Updated {name} with {len(all_amenities)} total amenities ({len(amenity_categories)} types)")
+            except Exception as e:
+                print(f"  ❌ Error updating {name}: {str(e)}")
+                failed_count += 1
+    
+    writer.close()
+    if detail_writer:
+        detail_writer.close()
+    updated_count -= writer.failed
+    failed_count += writer.failed
     
     print(f"\n{'='*60}")
     print(f"✅ Update Complete!")
-    print(f"📊 Total Processed: {total_stations}")
+    print(f"📊 Total Processed: {updated_count + failed_count}")
     print(f"✅ Successfully Updated: {updated_count}")
     print(f"❌ Failed: {failed_count}")
+    print(f"💾 Overpass cache: {overpass_cache.summary()}")
+    print(f"🌐 Overpass mirrors: {overpass_mirrors.summary()}")
     print(f"{'='*60}")
+    return {'mode': 'update-empty', 'updated': updated_count, 'failed': failed_count}
+
+def _amenity_changes(station, all_amenities):
+    """
+    Fields of a station that differ from freshly fetched amenities
+    Returns a dict ready for $set, empty when nothing changed
+    """
+    changes = {}
+    for field, value in amenity_fields(all_amenities).items():
+        stored = station.get(field)
+        if field == 'amenities':
+            changed = set(stored or []) != set(value)
+        elif field == 'amenitiesDetail':
+            changed = [{k: v for k, v in a.items() if k != '_id'} for a in stored or []] != value
+        else:
+            changed = stored != value
+        if changed:
+            changes[field] = value
+    return changes
 
-def import_stations_from_csv(csv_path):
-    """Import stations from CSV with ALL amenities pre-fetched"""
+def refresh_stale_amenities(max_age_days=None, budget=None, cluster=False, workers=None):
+    """
+    Re-fetch amenities for stations whose updatedAt is older than max_age_days
+    Stations never stamped come first, then the oldest; at most `budget` are
+    re-fetched per run. Only fields whose content changed are $set, plus updatedAt
+    so the station drops out of the stale set
+    """
+    max_age_days = REFRESH_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    budget = budget or REFRESH_BUDGET
+    workers = workers or OVERPASS_WORKERS
+    stats.reset()
     
-    print("🚀 Starting import process...")
-    print(f"📂 Reading CSV: {csv_path}")
+    cutoff = datetime.utcnow() - timedelta(days=max_age_days)
+    print(f"🚀 Refreshing amenities older than {max_age_days:g} days (before {cutoff:%Y-%m-%d %H:%M} UTC), budget {budget} stations...")
     
-    # Do NOT clear existing collection so we can skip duplicates
-    # collection.delete_many({})
-    # print("🗑️  Cleared existing stations\n")
+    query = {
+        '$or': [
+            {'updatedAt': {'$lt': cutoff}},
+            {'updatedAt': {'$exists': False}},
+            {'updatedAt': None}
+        ]
+    }
+    collection.create_index([('updatedAt', 1), ('_id', 1)])
+    
+    stale_total = collection.count_documents(query)
+    total_stations = min(stale_total, budget)
+    print(f"📊 Found {stale_total} stale stations; refreshing {total_stations} this run\n")
+    
+    if total_stations == 0:
+        print("✅ All station amenities are fresh!")
+        return {'mode': 'refresh-stale', 'stale': 0, 'refreshed': 0, 'changed': 0, 'unchanged': 0, 'failed': 0}
+    
+    counts = {'refreshed': 0, 'changed': 0, 'unchanged': 0, 'failed': 0}
+    fields_changed = {}
+    writer = BulkWriter(collection)
+    detail_writer = _detail_writer()
+    
+    projection = {'_id': 1, 'name': 1, 'city': 1, 'latitude': 1, 'longitude': 1,
+                  'amenities': 1, 'amenitiesSummary': 1, 'amenitiesDetail': 1}
     
-    imported_count = 0
-    error_count = 0
-    duplicate_count = 0  # track skipped duplicates
+    def located_stations():
+        # Missing updatedAt sorts before any date, so never-stamped stations go first
+        cursor = collection.find(query, projection, no_cursor_timeout=True).sort([('updatedAt', 1), ('_id', 1)]).limit(budget)
+        with cursor:
+            for station in cursor:
+                if not station.get('latitude') or not station.get('longitude'):
+                    print(f"⚠️  Skipping {station.get('name', 'Unknown')} - No coordinates")
+                    counts['failed'] += 1
+                    continue
+                yield station
     
-    with open(csv_path, 'r', encoding='utf-8') as file:
-        csv_reader = csv.DictReader(file)
+    units = group_work_units(located_stations(), cluster=cluster)
+    for unit, results, error in run_amenity_fetches(units, workers=workers):
+        if error:
+            for station in unit:
+                print(f"  ❌ Error refreshing {station.get('name', 'Unknown')}: {str(error)}")
+            counts['failed'] += len(unit)
+            continue
         
-        for idx, row in enumerate(csv_reader, 1):
+        stats.incr('stations', len(unit))
+        stats.progress()
+        for station, all_amenities in zip(unit, results):
+            name = station.get('name', 'Unknown')
+            if all_amenities is None:
+                # Keep the stored amenities and updatedAt so the station stays stale and is retried
+                print(f"  ❌ Error refreshing {name}: Overpass request failed")
+                counts['failed'] += 1
+                continue
+            changes = _amenity_changes(station, all_amenities)
+            for field in changes:
+                fields_changed[field] = fields_changed.get(field, 0) + 1
+            
+            changed = bool(changes)
+            changes['updatedAt'] = datetime.utcnow()
+            update = {'$set': changes}
+            if AMENITY_DETAIL_MODE != 'inline' and 'amenitiesDetail' in station:
+                update['$unset'] = {'amenitiesDetail': ''}
+            writer.update({'_id': station['_id']}, update, label=name)
+            # The separate full list can change without moving the station-level view (a renamed
+            # amenity beyond the top entries, one closing as another opens), so always rewrite it
+            _save_amenity_detail(detail_writer, station_key(name, station['latitude'], station['longitude']),
+                                 all_amenities, label=name)
+            
+            counts['refreshed'] += 1
+            if changed:
+                counts['changed'] += 1
+                print(f"  🔄 [{counts['refreshed']}/{total_stations}] {name}: {', '.join(k for k in changes if k != 'updatedAt')} changed ({len(all_amenities)} amenities)")
+            else:
+                counts['unchanged'] += 1
+    
+    writer.close()
+    if detail_writer:
+        detail_writer.close()
+    counts['refreshed'] -= writer.failed
+    counts['failed'] += writer.failed
+    
+    print(f"\n{'='*60}")
+    print(f"✅ Refresh Complete!")
+    print(f"📊 Refreshed: {counts['refreshed']} of {stale_total} stale stations")
+    print(f"🔄 Changed: {counts['changed']} ({', '.join(f'{k}: {v}' for k, v in fields_changed.items()) or 'no fields'})")
+    print(f"⏸️  Unchanged (only updatedAt bumped): {counts['unchanged']}")
+    print(f"❌ Failed: {counts['failed']}")
+    print(f"💾 Overpass cache: {overpass_cache.summary()}")
+    print(f"🌐 Overpass mirrors: {overpass_mirrors.summary()}")
+    print(f"{'='*60}")
+    return dict(counts, mode='refresh-stale', stale=stale_total, fieldsChanged=fields_changed)
+
+def build_station_document(name, city, address, latitude, longitude, charger_type, all_amenities):
+    """Build the evstations document for a CSV row and its fetched amenities"""
+    return {
+        'stationKey': station_key(name, latitude, longitude),
+        'name': name,
+        'city': city if city else 'Unknown',
+        'address': address if address else 'Address not available',
+        'latitude': latitude,
+        'longitude': longitude,
+        'location': location_point(latitude, longitude),
+        'type': determine_charger_type(charger_type),
+        **amenity_fields(all_amenities),
+        'powerKw': determine_power(charger_type),
+        'numberOfChargers': 1,
+        'isOperational': True,
+        'createdAt': datetime.utcnow(),
+        'updatedAt': datetime.utcnow(),
+        'importedFrom': 'CSV'
+    }
+
+def _iter_csv_rows(file, start_offset=None):
+    """
+    Yield (row dict, start offset, end offset) from an open CSV file
+    Lines are pulled with readline so tell()/seek() keep working; start_offset
+    resumes right after a previously committed row
+    """
+    header = next(csv.reader([file.readline()]))
+    if start_offset is not None:
+        file.seek(start_offset)
+    
+    offset = file.tell()
+    for row in csv.DictReader(iter(file.readline, ''), fieldnames=header):
+        end = file.tell()
+        yield row, offset, end
+        offset = end
+
+def _read_csv_candidates(csv_path, counts, name_index, checkpoint=None, resume_from=None):
+    """
+    Yield validated CSV rows as station dicts, skipping bad rows and duplicates
+    counts is updated in place with rows/errors/duplicates; resume_from is a
+    checkpoint position to seek to
+    """
+    start_row = resume_from['row'] if resume_from else 0
+    start_offset = resume_from['offset'] if resume_from else None
+    
+    with open(csv_path, 'r', encoding='utf-8', newline='') as file:
+        for idx, (row, row_start, row_end) in enumerate(_iter_csv_rows(file, start_offset), start_row + 1):
+            counts['rows'] = idx
+            queued = False
             try:
-                name = row.get('name', '').strip()
-                city = row.get('city', '').strip()
-                address = row.get('address', '').strip()
-                latitude = float(row.get('lattitude', 0))
-                longitude = float(row.get('longitude', 0))
-                charger_type = row.get('type', '').strip()
+                name = (row.get('name') or '').strip()
+                city = (row.get('city') or '').strip()
+                address = (row.get('address') or '').strip()
+                latitude = float(row.get('lattitude') or 0)
+                longitude = float(row.get('longitude') or 0)
+                charger_type = (row.get('type') or '').strip()
                 
                 # Skip if name missing
                 if not name:
                     print(f"⚠️  Skipping row {idx} - Missing name")
-                    error_count += 1
+                    counts['errors'] += 1
                     continue
                 
                 # Check for existing station with same name (case-insensitive)
-                existing = collection.find_one({'name': {'$regex': f'^{re.escape(name)}$', '$options': 'i'}})
-                if existing:
-                    print(f"⏭️  Skipping import for '{name}' - already exists in DB (id: {existing.get('_id')})")
-                    duplicate_count += 1
+                is_duplicate, existing_id = name_index.find(name, latitude, longitude)
+                if is_duplicate:
+                    if existing_id is None:
+                        print(f"⏭️  Skipping import for '{name}' - already queued in this run")
+                    else:
+                        print(f"⏭️  Skipping import for '{name}' - already exists in DB (id: {existing_id})")
+                    counts['duplicates'] += 1
                     continue
                 
-                # Skip if coordinates are invalid
-                if latitude == 0 or longitude == 0:
-                    print(f"⚠️  Skipping {name} - Invalid coordinates")
-                    error_count += 1
+                # Skip if coordinates are invalid (out of range would fail the location write on every run)
+                if latitude == 0 or longitude == 0 or not valid_coordinates(latitude, longitude):
+                    print(f"⚠️  Skipping {name} - Invalid coordinates ({latitude}, {longitude})")
+                    counts['errors'] += 1
                     continue
                 
-                print(f"\n[{idx}] Processing: {name}, {city}")
-                
-                # Fetch ALL amenities from OSM
-                all_amenities = fetch_amenities_from_osm(latitude, longitude, 2000)
-                
-                # Extract unique category names for quick filtering
-                amenity_categories = list(set([a['type'] for a in all_amenities]))
+                name_index.add(name, latitude, longitude)
+                queued = True
                 
+            except Exception as e:
+                print(f"  ❌ Error processing {row.get('name', 'Unknown')}: {str(e)}")
+                counts['errors'] += 1
+                continue
+            
+            finally:
+                if checkpoint:
+                    checkpoint.read(idx, row_start, row_end, in_flight=queued)
+            
+            yield {
+                'row': idx,
+                'name': name,
+                'city': city,
+                'address': address,
+                'latitude': latitude,
+                'longitude': longitude,
+                'charger_type': charger_type
+            }
+
+def import_stations_from_csv(csv_path, cluster=False, workers=None, dedup_by_coords=None,
+                             resume=False, checkpoint_path=None):
+    """
+    Import stations from CSV with ALL amenities pre-fetched
+    With cluster=True, nearby stations share one Overpass bbox query per grid tile
+    With workers > 1, requests run concurrently under the shared token bucket
+    dedup_by_coords overrides DEDUP_BY_COORDS for duplicate detection
+    Progress is checkpointed to checkpoint_path (default <csv>.checkpoint.json);
+    resume=True continues from the last committed row of a previous run
+    """
+    workers = workers or OVERPASS_WORKERS
+    stats.reset()
+    
+    print("🚀 Starting import process...")
+    print(f"📂 Reading CSV: {csv_path}")
+    
+    # Do NOT clear existing collection so we can skip duplicates
+    # collection.delete_many({})
+    # print("🗑️  Cleared existing stations\n")
+    
+    counts = {'rows': 0, 'errors': 0, 'duplicates': 0}
+    
+    checkpoint = ImportCheckpoint(checkpoint_path or csv_path + '.checkpoint.json', csv_path)
+    resume_from = checkpoint.load() if resume else None
+    if resume_from:
+        print(f"⏩ Resuming after row {resume_from['row']} ({len(resume_from.get('inFlightRows', []))} rows were in flight)")
+    elif resume:
+        print("⚠️  No usable checkpoint found - starting from row 1")
+    
+    detail_writer = _detail_writer()
+    
+    def committed(rows):
+        # Full amenity lists land before their rows count as committed for --resume
+        if detail_writer:
+            detail_writer.flush()
+        checkpoint.release(rows)
+    
+    writer = BulkWriter(collection, on_flush=committed)
+    
+    # Upserts are keyed on stationKey so replayed rows never create duplicates
+    collection.create_index('stationKey', unique=True, sparse=True)
+    ensure_location_index()
+    
+    # Existing names are loaded once so each row's duplicate check is a set lookup
+    name_index = StationNameIndex(by_coords=dedup_by_coords).load(collection)
+    print(f"📇 Loaded {len(name_index)} existing stations for duplicate checks")
+    
+    candidates = _read_csv_candidates(csv_path, counts, name_index, checkpoint, resume_from)
+    units = group_work_units(candidates, cluster=cluster)
+    for unit, results, error in run_amenity_fetches(units, workers=workers):
+        if error:
+            for candidate in unit:
+                print(f"  ❌ Error processing {candidate['name']}: {str(error)}")
+            counts['errors'] += len(unit)
+            checkpoint.release([c['row'] for c in unit])
+            continue
+        
+        stats.incr('stations', len(unit))
+        stats.progress()
+        for candidate, all_amenities in zip(unit, results):
+            if all_amenities is None:
+                # Import the station without amenities; --update-empty fills them in later
+                print(f"  ⚠️  Overpass request failed for {candidate['name']} - importing without amenities")
+                all_amenities = []
+            try:
                 # Prepare station document
-                station = {
-                    'name': name,
-                    'city': city if city else 'Unknown',
-                    'address': address if address else 'Address not available',
-                    'latitude': latitude,
-                    'longitude': longitude,
-                    'type': determine_charger_type(charger_type),
-                    'amenities': amenity_categories,
-                    'amenitiesDetail': all_amenities,  # Store ALL amenities
-                    'powerKw': determine_power(charger_type),
-                    'numberOfChargers': 1,
-                    'isOperational': True,
-                    'createdAt': datetime.utcnow(),
-                    'importedFrom': 'CSV'
-                }
-                
-                # Insert into MongoDB
-                collection.insert_one(station)
-                imported_count += 1
-                
-                print(f"  ✅ Imported with {len(all_amenities)} total amenities ({len(amenity_categories)} types)")
+                station = build_station_document(
+                    candidate['name'], candidate['city'], candidate['address'],
+                    candidate['latitude'], candidate['longitude'], candidate['charger_type'],
+                    all_amenities
+                )
+                created_at = station.pop('createdAt')
                 
-                # Rate limiting - wait between requests
-                time.sleep(IMPORT_SLEEP_SECONDS)
+                # Queue an idempotent upsert for the next bulk write into MongoDB
+                update = _amenity_update(station)
+                update['$setOnInsert'] = {'createdAt': created_at}
+                writer.update(
+                    {'stationKey': station['stationKey']},
+                    update,
+                    label=candidate['name'],
+                    upsert=True,
+                    ref=candidate['row']
+                )
+                _save_amenity_detail(detail_writer, station['stationKey'], all_amenities, label=candidate['name'])
                 
+                print(f"  ✅ [{candidate['row']}] Queued {candidate['name']} with {len(all_amenities)} total amenities ({len(station['amenities'])} types)")
             except Exception as e:
-                print(f"  ❌ Error processing {row.get('name', 'Unknown')}: {str(e)}")
-                error_count += 1
-                continue
+                print(f"  ❌ Error processing {candidate['name']}: {str(e)}")
+                counts['errors'] += 1
+                checkpoint.release([candidate['row']])
+        
+        checkpoint.save(counts)
+    
+    writer.close()
+    if detail_writer:
+        detail_writer.close()
+    counts['errors'] += writer.failed
+    if checkpoint.pending:
+        # Rows whose write failed stay pending so --resume retries them
+        checkpoint.save(counts, force=True)
+        print(f"⚠️  {len(checkpoint.pending)} rows failed to write - run again with --resume to retry them")
+    else:
+        # Everything is committed; a later --resume should start over rather than skip the file
+        checkpoint.clear()
     
     print(f"\n{'='*60}")
     print(f"✅ Import Complete!")
-    print(f"📊 Total Processed: {idx}")
-    print(f"✅ Successfully Imported: {imported_count}")
-    print(f"⏭️  Duplicates Skipped: {duplicate_count}")
-    print(f"❌ Errors: {error_count}")
+    print(f"📊 Total Processed: {counts['rows']}")
+    print(f"✅ Successfully Imported: {writer.upserted} new, {writer.updated} already present ({writer.batches} bulk writes)")
+    print(f"⏭️  Duplicates Skipped: {counts['duplicates']}")
+    print(f"❌ Errors: {counts['errors']}")
+    print(f"💾 Overpass cache: {overpass_cache.summary()}")
+    print(f"🌐 Overpass mirrors: {overpass_mirrors.summary()}")
     print(f"{'='*60}")
+    return {
+        'mode': 'import',
+        'rows': counts['rows'],
+        'imported': writer.upserted,
+        'alreadyPresent': writer.updated,
+        'duplicates': counts['duplicates'],
+        'errors': counts['errors']
+    }
 
 def determine_charger_type(type_str):
     """Determine charger type from CSV type field"""
@@ -412,25 +1857,102 @@ def determine_power(type_str):
     return power_map.get(type_num, 50)
 
 if __name__ == "__main__":
+    import argparse
     import sys
     
-    # Check command line argument
-    if len(sys.argv) > 1 and sys.argv[1] == '--update-empty':
-        # Update mode - only update stations with empty amenities
-        update_stations_with_empty_amenities()
-    else:
+    parser = argparse.ArgumentParser(description="Import EV stations from CSV into MongoDB with pre-fetched amenities")
+    parser.add_argument('--update-empty', action='store_true',
+                        help="only fetch amenities for stations already in DB with empty amenities")
+    parser.add_argument('--backfill-location', action='store_true',
+                        help="one-shot migration: write a GeoJSON location for existing stations and ensure the 2dsphere index")
+    parser.add_argument('--refresh-stale', action='store_true',
+                        help="re-fetch amenities for stations whose updatedAt is older than --max-age-days, writing only what changed")
+    parser.add_argument('--max-age-days', type=float, default=REFRESH_MAX_AGE_DAYS,
+                        help="with --refresh-stale, how old updatedAt must be for a station to be refreshed")
+    parser.add_argument('--budget', type=int, default=REFRESH_BUDGET,
+                        help="with --refresh-stale, the most stations re-fetched in this run")
+    parser.add_argument('--cluster', action='store_true',
+                        help="share one Overpass bbox query per grid tile of CLUSTER_CELL_METERS")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="always query Overpass instead of reading/writing the local response cache")
+    parser.add_argument('--amenity-detail', choices=['inline', 'separate', 'drop'], default=AMENITY_DETAIL_MODE,
+                        help="keep the full amenitiesDetail list on stations (inline), in the stationamenities collection (separate), or drop it")
+    parser.add_argument('--dedup-coords', action='store_true', default=None,
+                        help="treat rows as duplicates only when name AND rounded coordinates match")
+    parser.add_argument('--osm-extract', default=os.getenv('OSM_EXTRACT_PATH'),
+                        help="answer amenity queries from a local OSM extract (.geojson, Overpass .json, .csv or .pbf) instead of Overpass")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue a CSV import from its last checkpoint (<csv>.checkpoint.json or CHECKPOINT_PATH)")
+    parser.add_argument('--shard', type=parse_shard,
+                        help="with --update-empty, only process slice i/N (1-based) so N processes can split the work")
+    parser.add_argument('--shard-mode', choices=['hash', 'range'], default='hash',
+                        help="split shards by a hash of _id (default) or by contiguous _id ranges")
+    parser.add_argument('--workers', type=int, default=OVERPASS_WORKERS,
+                        help="Overpass requests in flight; above 1 replaces fixed sleeps with the OVERPASS_RATE token bucket")
+    parser.add_argument('--report', default=os.getenv('RUN_REPORT_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import_run_report.json')),
+                        help="where to write the JSON run report (timings, counters, throughput)")
+    parser.add_argument('--progress', type=float, default=float(os.getenv('PROGRESS_SECONDS', '0')),
+                        help="print a progress line every N seconds (0 = off)")
+    parser.add_argument('--profile', nargs='?', const='import_profile.prof', default=None,
+                        help="run under cProfile and save stats to this file (default import_profile.prof)")
+    args = parser.parse_args()
+    
+    stats.progress_every = args.progress
+    AMENITY_DETAIL_MODE = args.amenity_detail
+    
+    if args.no_cache:
+        overpass_cache.enabled = False
+    
+    if args.osm_extract:
+        print(f"🗺️  Loading offline amenities from {args.osm_extract}...")
+        offline_index = OfflineAmenityIndex.from_file(args.osm_extract)
+        print(f"✅ Indexed {len(offline_index)} amenities in {len(offline_index.cells)} grid cells\n")
+    
+    CSV_FILE_PATH = os.getenv('CSV_FILE_PATH', r".\ev-charging-stations-india.csv")
+    
+    def run():
+        if args.backfill_location:
+            return backfill_locations()
+        if args.refresh_stale:
+            # Refresh mode - re-fetch the stalest stations within the budget
+            return refresh_stale_amenities(max_age_days=args.max_age_days, budget=args.budget,
+                                           cluster=args.cluster, workers=args.workers)
+        if args.update_empty:
+            # Update mode - only update stations with empty amenities
+            return update_stations_with_empty_amenities(cluster=args.cluster, workers=args.workers,
+                                                        shard=args.shard, shard_mode=args.shard_mode)
         # Import mode - full import from CSV
-        CSV_FILE_PATH = os.getenv('CSV_FILE_PATH', r".\ev-charging-stations-india.csv")
-        
+        return import_stations_from_csv(CSV_FILE_PATH, cluster=args.cluster, workers=args.workers,
+                                        dedup_by_coords=args.dedup_coords, resume=args.resume,
+                                        checkpoint_path=os.getenv('CHECKPOINT_PATH'))
+    
+    if not (args.update_empty or args.refresh_stale or args.backfill_location):
         # Check if file exists
         if not os.path.exists(CSV_FILE_PATH):
             print(f"❌ CSV file not found: {CSV_FILE_PATH}")
             print(f"\nUsage:")
             print(f"  Full import: python {sys.argv[0]}")
             print(f"  Update empty: python {sys.argv[0]} --update-empty")
+            print(f"  Refresh stale: python {sys.argv[0]} --refresh-stale --max-age-days 30 --budget 500")
+            print(f"  Backfill GeoJSON locations: python {sys.argv[0]} --backfill-location")
+            print(f"  Clustered (fewer Overpass requests): python {sys.argv[0]} --cluster")
             exit(1)
+    
+    if args.profile:
+        import cProfile
+        import pstats
         
-        # Start import
-        import_stations_from_csv(CSV_FILE_PATH)
+        profiler = cProfile.Profile()
+        result = profiler.runcall(run)
+        profiler.dump_stats(args.profile)
+        print(f"\n🔬 Profile saved to {args.profile}; top functions by cumulative time:")
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+    else:
+        result = run()
+    
+    stats.progress(force=True)
+    stats.write_report(args.report, result=result, workers=args.workers, cluster=args.cluster,
+                       offline=bool(args.osm_extract))
+    print(f"📈 Run report written to {args.report}")
     
     print("\n🎉 All done! Stations are now in MongoDB with pre-fetched amenities.")
@@ -5,8 +5,8 @@ exports.getNearbyStations = async (lat, lng, radiusKm = 50) => {
   try {
     console.log(`🔍 Searching LOCAL DB for stations within ${radiusKm}km of ${lat},${lng}`);
     
-    // Fetch all operational stations from MongoDB
-    const allStations = await EVStation.find({ isOperational: true });
+    // Fetch all operational stations from MongoDB (the full amenity list stays behind; the summary covers it)
+    const allStations = await EVStation.find({ isOperational: true }).select('-amenitiesDetail');
     
     if (allStations.length === 0) {
       console.warn('⚠️  No stations found in database. Run: python scripts/import_stations_with_amenities.py');
@@ -34,7 +34,8 @@ exports.getNearbyStations = async (lat, lng, radiusKm = 50) => {
           powerKw: station.powerKw,
           numberOfChargers: station.numberOfChargers,
           amenities: station.amenities || [], // Pre-fetched from DB
-          amenitiesDetail: station.amenitiesDetail || [], // Detailed info with distances
+          amenitiesDetail: EVStation.amenityList(station), // Nearest amenities per category with distances
+          amenitiesSummary: station.amenitiesSummary || {}, // Per-category counts and nearest entries
           distance: Math.round(distance * 100) / 100 // Round to 2 decimals
         };
       })